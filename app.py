@@ -1,502 +1,933 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file
-from flask_socketio import SocketIO, emit
+from flask import Blueprint, Flask, current_app, g, render_template, request, jsonify, session, redirect, url_for, send_file, stream_with_context
+from flask.cli import AppGroup
+from flask_socketio import SocketIO, join_room
 from functools import wraps
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from itsdangerous import URLSafeTimedSerializer
-import sqlite3
-import qrcode
+import click
+import json
 from io import BytesIO
-import os
+import threading
+import time
+import zipfile
 
 import database as db
+import events
+import metrics
+import qr
+from settings import load_config
+
+bp = Blueprint('kitchen', __name__)
+socketio = SocketIO()
+
+def socketio_options(config):
+    """SocketIO() arguments for the configured ASYNC_MODE and MESSAGE_QUEUE.
+
+    MESSAGE_QUEUE takes any URL Flask-SocketIO supports (redis://, kafka://,
+    zmq+tcp://, amqp://, ...) or sqlite://<path> for the local stand-in that
+    shares broadcasts between workers on one machine through a SQLite file.
+    With MESSAGE_QUEUE_WRITE_ONLY=1 a sqlite:// queue is only published to,
+    for processes that emit but serve no clients.
+    """
+    options = {}
+    if config.get('ASYNC_MODE'):
+        options['async_mode'] = config['ASYNC_MODE']
+    queue = config.get('MESSAGE_QUEUE')
+    if queue and queue.startswith('sqlite://'):
+        from sqlite_queue import SQLiteQueueManager
+        options['client_manager'] = SQLiteQueueManager(queue, write_only=config.get('MESSAGE_QUEUE_WRITE_ONLY') == '1')
+    elif queue:
+        options['message_queue'] = queue
+    return options
+
+def create_app(config=None, check_schema=True):
+    """Build the app from config, by default config.properties plus KITCHEN_*
+    environment overrides.
+
+    Nothing is written to the database here: startup only compares its
+    user_version with the schema this code expects. Create or upgrade it
+    with `flask --app app kitchen init-db`; until then requests get a 503.
+    Entry points that run init_db() themselves pass check_schema=False.
+    """
+    if config is None:
+        config = load_config()
+    app = Flask(__name__)
+    app.secret_key = "burger-order-secret-key-change-this-in-production"
+    app.config.update(
+        BASE_URL=config.get('BASE_URL', 'http://localhost:5001'),
+        DB_PATH=config.get('DB_PATH', 'kitchen.db'),
+        KITCHEN_CONFIG=config,
+    )
 
-app = Flask(__name__)
-app.secret_key = "burger-order-secret-key-change-this-in-production"
-s = URLSafeTimedSerializer(app.secret_key)
-socketio = SocketIO(app)
-
-# Load BASE_URL from config.properties
-def load_config():
-    config = {}
-    config_file = os.path.join(os.path.dirname(__file__), 'config.properties')
-    if os.path.exists(config_file):
-        with open(config_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    config[key.strip()] = value.strip()
-    return config
-
-config = load_config()
-BASE_URL = config.get('BASE_URL', 'http://localhost:5001')
-DB_PATH = config.get('DB_PATH', 'kitchen.db') # Get DB_PATH from config
-
-# Set the database file in the database module
-db.set_db_file(DB_PATH)
-
-# Setup the database
-db.setup_database()
+    # Set the database file and connection pragmas in the database module
+    db.set_db_file(app.config['DB_PATH'])
+    db.configure(config)
+    db.init_app(app)
+    metrics.init_app(app, config)
+    qr.configure(config)
+
+    app.register_blueprint(bp)
+    app.cli.add_command(kitchen_cli)
+    socketio.init_app(app, **socketio_options(config))
+
+    if check_schema:
+        with app.app_context():
+            version = db.get_schema_version(db.get_connection())
+        if version != db.SCHEMA_VERSION:
+            message = (f"{app.config['DB_PATH']} is at schema version {version}, expected {db.SCHEMA_VERSION}; "
+                       "run `flask --app app kitchen init-db`")
+            app.logger.error(message)
+            app.before_request(lambda: (jsonify({"error": message}), 503))
+    return app
+
+def serializer():
+    return URLSafeTimedSerializer(current_app.secret_key)
 
 def setup_admin_user():
-    with app.app_context():
-        admin = db.get_user_by_username('admin')
-        if not admin:
-            conn = db.get_db_connection()
-            conn.execute("INSERT INTO users (id, username, role, name, gender, is_delivery) VALUES (?, ?, ?, ?, ?, ?)",
-                         (1, "admin", "admin", "Administrator", "admin", 0))
-            conn.commit()
-            conn.close()
-            admin = db.get_user_by_username('admin')
-
-        token = s.dumps("admin", salt='magic-link')
-        
-        conn = db.get_db_connection()
-        # Delete existing tokens for admin user to avoid duplicates
-        conn.execute("DELETE FROM magic_links WHERE user_id = ?", (admin['id'],))
-        conn.execute("INSERT INTO magic_links (user_id, token, expires_at) VALUES (?, ?, ?)",
-                     (admin['id'], token, (datetime.now() + timedelta(days=365)).isoformat()))
+    admin = db.get_user_by_username('admin')
+    if not admin:
+        conn = db.get_connection()
+        conn.execute("INSERT INTO users (id, username, password, role, name, gender, is_delivery) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (1, "admin", "", "admin", "Administrator", "admin", 0))
+        db.invalidate_cache('users', conn)
         conn.commit()
-        conn.close()
-        
-        print("====================================================")
-        print("INITIAL ADMIN LOGIN")
-        print("Use the following link to log in as the admin user:")
-        print(f"{BASE_URL}/magic-login/{token}")
-        print("====================================================")
-
-setup_admin_user()
+        admin = db.get_user_by_username('admin')
 
-# Login decorators
+    token = serializer().dumps("admin", salt='magic-link')
+
+    with db.write_transaction():
+        # Replaces any existing tokens for the admin user
+        db.replace_magic_links([(admin['id'], token, (datetime.now() + timedelta(days=365)).isoformat())])
+
+    print("====================================================")
+    print("INITIAL ADMIN LOGIN")
+    print("Use the following link to log in as the admin user:")
+    print(f"{current_app.config['BASE_URL']}/magic-login/{token}")
+    print("====================================================")
+
+def init_db():
+    """Create or migrate the schema, seed it and issue the admin login link."""
+    db.setup_database()
+    setup_admin_user()
+
+kitchen_cli = AppGroup('kitchen', help='Kitchen orders administration.')
+
+@kitchen_cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the database and print an admin login link."""
+    init_db()
+
+@kitchen_cli.command('sweep-links')
+def sweep_links_command():
+    """Delete expired magic links."""
+    click.echo(f"Deleted {db.delete_expired_magic_links()} expired magic links")
+
+@kitchen_cli.command('archive-orders')
+def archive_orders_command():
+    """Archive delivered and cancelled orders older than ORDER_ARCHIVE_AGE hours."""
+    click.echo(f"Archived {archive_finished_orders(current_app)} finished orders")
+
+@kitchen_cli.command('compact-events')
+def compact_events_command():
+    """Delete order events older than EVENT_RETENTION hours."""
+    click.echo(f"Deleted {compact_event_log(current_app)} order events")
+
+def current_user():
+    """The logged-in user, resolved once per request from the versioned users
+    cache. None when logged out, when the user no longer exists or when the
+    session's stamp no longer matches their session_version."""
+    if 'current_user' not in g:
+        user = db.get_user_by_id(session['user_id']) if 'user_id' in session else None
+        if user and session.setdefault('user_version', user['session_version']) != user['session_version']:
+            user = None  # Sessions from before stamps existed are stamped on first use, above
+        if user is None and 'user_id' in session:
+            session.clear()
+        g.current_user = user
+    return g.current_user
+
+# Login decorators; API requests get 401 or 403 instead of a redirect
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login'))
+        if current_user() is None:
+            if request.path.startswith('/api/'):
+                return {"success": False, "message": "Not logged in"}, 401
+            return redirect(url_for('kitchen.login'))
         return f(*args, **kwargs)
     return decorated_function
 
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login'))
-        user = db.get_user_by_id(session['user_id'])
-        if not user or user['role'] != 'admin':
-            return redirect(url_for('order_page'))
+        user = current_user()
+        if user is None:
+            if request.path.startswith('/api/'):
+                return {"success": False, "message": "Not logged in"}, 401
+            return redirect(url_for('kitchen.login'))
+        if user['role'] != 'admin':
+            if request.path.startswith('/api/'):
+                return {"success": False, "message": "Admin access required"}, 403
+            return redirect(url_for('kitchen.order_page'))
         return f(*args, **kwargs)
     return decorated_function
 
-def notify_clients(order_id=None):
-    """Notifies clients about order updates."""
-    if order_id:
-        socketio.emit('order_updated', {'order_id': order_id})
-    else:
-        socketio.emit('update_orders')
+# Order statuses delivery riders are told about
+DELIVERY_STATUSES = ('ready', 'out_for_delivery', 'delivered', 'cancelled')
 
-@app.route("/")
+def client_rooms(user):
+    """Socket.IO rooms a user's clients join, based on their role."""
+    if not user:
+        return []
+    rooms = [f"user:{user['id']}"]
+    if user['role'] == 'admin':
+        rooms += ['kitchen', 'admin']
+    if user.get('is_delivery'):
+        rooms.append('delivery')
+    return rooms
+
+def order_rooms(order):
+    """The kitchen, the order's owner and, for pickup statuses, the riders."""
+    rooms = ['kitchen'] + ([f"user:{order['user_id']}"] if order['user_id'] else [])
+    if order['status'] in DELIVERY_STATUSES:
+        rooms.append('delivery')
+    return rooms
+
+def notify_clients(order_id=None, changed=None, rooms=None, order=None, conn=None):
+    """Notifies clients about order updates.
+
+    Order events carry the full order, its status, the names of the changed
+    fields and its progress, so clients can apply them without refetching.
+    They go to the rooms from order_rooms() unless rooms is given. General
+    updates go to rooms, or to everyone when it is None. Every event is
+    recorded in order_events under a sequence number; see
+    /api/orders/changes. Pass the conn of an open write transaction to record
+    it with the change: it is emitted once that commits. Pass order when the
+    caller already holds the updated order, to skip reloading it.
+    """
+    conn = conn or db.get_connection()
+    with db.write_transaction(conn):
+        if order_id:
+            if order is None:
+                order = db.get_order_details(order_id, conn)
+            if rooms is None:
+                rooms = order_rooms(order) if order else ['kitchen']
+            event = events.publish('order_updated', {
+                'order_id': order_id,
+                'order': order,
+                'status': order['status'] if order else None,
+                'deleted': order is None,
+                'changed': changed or [],
+                'progress': db.get_progress(order_id, conn) if order else [],
+            }, rooms, conn)
+        else:
+            event = events.publish('update_orders', rooms=rooms, conn=conn)
+    db.after_commit(conn, lambda: emit_event(event, rooms))
+
+def emit_event(event, rooms):
+    socketio.emit(event['event'], event, to=rooms)
+    metrics.count_emit(event['event'])
+    events.committed()
+
+@bp.route("/")
 @login_required
 def order_page():
-    user = db.get_user_by_id(session['user_id'])
-    can_order = db.can_user_order(session['user_id'])
-    current_order = db.get_user_current_order(session['user_id'])
-    is_delivery = db.is_user_delivery(session['user_id'])
-    return render_template("order.html", user=user, can_order=can_order, current_order=current_order, is_delivery=is_delivery)
-
-@app.route("/login")
+    user = current_user()
+    # Read directly: a delivery handled by another worker re-enables it
+    can_order = db.can_user_order(user['id'])
+    current_order = db.get_user_current_order(user['id'])
+    return render_template("order.html", user=user, can_order=can_order, current_order=current_order, is_delivery=user['is_delivery'],
+                           bootstrap=build_bootstrap(user['id'], 'order'))
+
+@bp.route("/login")
 def login():
     return render_template("login.html")
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.clear()
-    return redirect(url_for('login'))
+    return redirect(url_for('kitchen.login'))
 
-@app.route("/admin")
+@bp.route("/admin")
 @admin_required
 def admin_page():
     return render_template("admin.html")
 
-@app.route("/kitchen")
+@bp.route("/kitchen")
 @admin_required
 def kitchen_page():
-    return render_template("kitchen.html")
-
-@app.route("/api/orders", methods=["GET"])
+    return render_template("kitchen.html", bootstrap=build_bootstrap(current_user()['id'], 'kitchen'))
+
+# Order statuses the kitchen screen loads in full; delivered orders load lazily
+KITCHEN_LIVE_STATUSES = ['pending', 'preparing', 'ready', 'out_for_delivery']
+
+def build_board(conn=None):
+    """The kitchen board: live orders with their progress, grouped by status,
+    and the number of orders in every status."""
+    board = {status: [] for status in KITCHEN_LIVE_STATUSES}
+    for order in with_progress(db.get_orders(conn, statuses=KITCHEN_LIVE_STATUSES), conn):
+        board[order['status']].append(order)
+    return {"counts": db.get_status_counts(conn), "orders": board}
+
+def build_bootstrap(user_id, page, conn=None):
+    """Everything order.html or kitchen.html needs for first paint, read on
+    one connection so the page starts without a chain of API calls.
+
+    seq is taken before anything is read: events after it may already be
+    reflected in the payload, and replaying them is harmless.
+    """
+    conn = conn or db.get_connection()
+    data = {"seq": events.last_seq(conn), "ingredients": db.get_ingredients(conn)}
+    if page == 'kitchen':
+        data["board"] = build_board(conn)
+    else:
+        data["order_status"] = order_status(user_id, conn)
+        data["history"] = db.get_user_order_history(user_id, conn)
+        if db.is_user_delivery(user_id, conn):
+            data["ready_orders"] = db.get_ready_orders_for_delivery(conn)
+            data["my_deliveries"] = db.get_my_deliveries(user_id, conn)
+    return data
+
+@bp.route("/api/bootstrap", methods=["GET"])
+@login_required
+def get_bootstrap():
+    """The page bootstrap payload; ?page=order (default) or ?page=kitchen."""
+    page = request.args.get('page', 'order')
+    user = current_user()
+    if page == 'kitchen':
+        if user['role'] != 'admin':
+            return {"error": "Forbidden"}, 403
+    elif page != 'order':
+        return {"error": "Unknown page"}, 400
+    return jsonify(build_bootstrap(user['id'], page))
+
+# Order fields kept by ?fields=compact, besides the ingredient flags
+COMPACT_ORDER_FIELDS = ('id', 'status', 'person_type', 'order_count', 'additional_instructions', 'progress')
+
+def with_progress(orders, conn=None):
+    """Adds each order's ticked ingredient keys as 'progress', in one query."""
+    progress = db.get_progress_by_order([o['id'] for o in orders], conn)
+    for o in orders:
+        o['progress'] = progress[o['id']]
+    return orders
+MAX_ORDERS_PAGE = 500
+
+@bp.route("/api/orders", methods=["GET"])
 def get_orders():
-    orders = db.get_orders()
-    return jsonify(orders)
-
-@app.route("/api/orders", methods=["POST"])
+    """List orders.
+
+    Query parameters: status (comma separated), since (ISO timestamp),
+    limit and cursor (the X-Next-Cursor of the previous page), and
+    fields=compact. Each order includes its ticked ingredients as progress.
+    Responses carry an ETag and Last-Modified from the orders and
+    ingredients change counters, so unchanged polls get 304 Not Modified.
+    """
+    statuses = [st for st in request.args.get('status', '').split(',') if st]
+    since = request.args.get('since')
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor', type=int)
+    compact = request.args.get('fields') == 'compact'
+    if limit is not None:
+        limit = max(1, min(limit, MAX_ORDERS_PAGE))
+
+    def build():
+        orders = with_progress(db.get_orders(statuses=statuses, since=since, after_id=cursor, limit=limit))
+        if compact:
+            orders = [{k: v for k, v in o.items() if k in COMPACT_ORDER_FIELDS or v == "True"} for o in orders]
+        response = jsonify(orders)
+        if limit is not None and len(orders) == limit:
+            response.headers['X-Next-Cursor'] = str(orders[-1]['id'])
+        return response
+    return orders_response('orders', build)
+
+@bp.route("/api/orders/board", methods=["GET"])
+@admin_required
+def get_order_board():
+    """The kitchen board: {"counts": {status: n}, "orders": {status: [...]}}
+    with the live statuses' orders in full. Delivered orders are listed by
+    /api/orders/delivered. Conditional like /api/orders."""
+    return orders_response('board', lambda: jsonify(build_board()))
+
+def orders_response(name, build):
+    """Wraps build() in the headers shared by the order listings: an ETag
+    and Last-Modified from the orders and ingredients change counters, so
+    unchanged polls get 304 Not Modified without building anything, and
+    X-Event-Seq to resume events from."""
+    # Read the sequence first so clients replay anything that lands meanwhile
+    seq = events.last_seq()
+    orders_version, ingredients_version, updated_at = db.get_orders_version()
+    etag = f"{name}-{orders_version}-{ingredients_version}"
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    if updated_at:
+        response.last_modified = datetime.fromisoformat(updated_at).replace(tzinfo=timezone.utc)
+    response.cache_control.no_cache = True
+    response.headers['X-Event-Seq'] = str(seq)
+    return response.make_conditional(request)
+
+@bp.route("/api/orders/changes", methods=["GET"])
+@login_required
+def get_order_changes():
+    since = request.args.get('since', 0, type=int)
+    seq = events.last_seq()
+    missed = events.since(since, client_rooms(current_user()))
+    if missed is None:
+        # Too far behind (or the log was compacted): the client must reload
+        return jsonify({"seq": seq, "reset": True, "events": []})
+    return jsonify({"seq": seq, "reset": False, "events": missed})
+
+@bp.route("/api/stream", methods=["GET"])
+@login_required
+def event_stream():
+    """Server-Sent Events alternative to Socket.IO for clients whose
+    websocket upgrades fail: one long-lived response carrying the same events
+    as /api/orders/changes, each with its sequence number as the event id.
+    Starts after the Last-Event-ID header (sent by EventSource when it
+    reconnects) or ?since=, else at the current sequence. When those events
+    are no longer retained it sends a "reset" event and closes, and the client
+    must reload. Idle streams get a comment every STREAM_HEARTBEAT seconds so
+    proxies keep them open."""
+    config = current_app.config['KITCHEN_CONFIG']
+    poll = float(config.get('STREAM_POLL_INTERVAL', 1))
+    heartbeat = float(config.get('STREAM_HEARTBEAT', 15))
+    rooms = client_rooms(current_user())
+    last = request.headers.get('Last-Event-ID', type=int)
+    if last is None:
+        last = request.args.get('since', type=int)
+    if last is None:
+        last = events.last_seq()
+
+    def generate(last):
+        yield "retry: 3000\n\n"
+        idle_since = time.monotonic()
+        while True:
+            seq = events.last_seq()
+            if seq != last:
+                missed = events.since(last, rooms)
+                if missed is None:
+                    yield f"event: reset\ndata: {json.dumps({'seq': seq})}\n\n"
+                    return
+                for event in missed:
+                    yield f"id: {event['seq']}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n"
+                last = max([seq] + [event['seq'] for event in missed])
+                if missed:
+                    idle_since = time.monotonic()
+            if time.monotonic() - idle_since >= heartbeat:
+                yield ": heartbeat\n\n"
+                idle_since = time.monotonic()
+            # Woken by this worker's commits; other workers' show up on the next poll
+            events.wait(poll)
+
+    response = current_app.response_class(stream_with_context(generate(last)), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Stop nginx buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@bp.route("/api/orders", methods=["POST"])
 @login_required
 def add_order():
-    if not db.can_user_order(session.get('user_id')):
+    user = current_user()
+    if not db.can_user_order(user['id']):
         return {"success": False, "message": "You don't have permission to order right now"}, 403
     
-    current_order = db.get_user_current_order(session.get('user_id'))
+    current_order = db.get_user_current_order(user['id'])
     if current_order:
         return {"success": False, "message": "You already have an order. Please wait for it to be delivered."}, 400
     
     data = request.json
-    user = db.get_user_by_id(session.get('user_id'))
-    if not user:
-        return {"success": False, "message": "User not found"}, 404
     
     gender_map = {"male": "Male", "female": "Female", "kid": "Child"}
     person_type = gender_map.get(user.get('gender', 'male'), 'Male')
     
-    user_delivered_orders = db.get_user_order_history(user['id'])
-    order_count = len(user_delivered_orders) + 1
-    
-    conn = db.get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute(
-        "INSERT INTO orders (name, person_type, order_count, additional_instructions, status, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-        (data["name"], person_type, order_count, data.get("additional_instructions", ""), "pending", datetime.now().isoformat())
-    )
-    order_id = cursor.lastrowid
+    order_count = db.get_delivered_count(user['id']) + 1
     
-    current_options = db.get_option_keys()
-    for option in current_options:
-        if data.get(option):
-            # We need to get the ingredient id from the name
-            ingredient_name = option.replace('_', ' ')
-            ingredient = conn.execute('SELECT id FROM ingredients WHERE name LIKE ?', (f'%{ingredient_name}%',)).fetchone()
-            if ingredient:
-                cursor.execute("INSERT INTO order_ingredients (order_id, ingredient_id) VALUES (?, ?)", (order_id, ingredient['id']))
-
-    conn.commit()
-    conn.close()
-    notify_clients(order_id) # Emit specific order update
+    # Resolve every selected option in one pass over the cached key -> id map
+    option_ids = db.get_option_map()
+    ingredient_ids = [option_ids[option] for option, selected in data.items() if selected and option in option_ids]
+
+    with db.write_transaction() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(
+            "INSERT INTO orders (user_id, name, person_type, order_count, additional_instructions, status, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user['id'], data["name"], person_type, order_count, data.get("additional_instructions", ""), "pending", datetime.now().isoformat())
+        )
+        order_id = cursor.lastrowid
+
+        cursor.executemany("INSERT INTO order_ingredients (order_id, ingredient_id) VALUES (?, ?)",
+                           [(order_id, ingredient_id) for ingredient_id in ingredient_ids])
+
+        notify_clients(order_id, ['created'], conn=conn) # Emit specific order update
     
     return {"success": True}
 
 
-@app.route("/api/orders/<int:order_id>/ready", methods=["POST"])
-def mark_ready(order_id):
-    conn = db.get_db_connection()
-    conn.execute('UPDATE orders SET status = "ready" WHERE id = ?', (order_id,))
-    conn.commit()
-    conn.close()
-    notify_clients(order_id) # Emit specific order update
+def transition_response(order_id, applied, order, changed, conn=None):
+    """Broadcasts an applied status transition, or reports why it was not
+    applied. Call with the transition's open transaction."""
+    if order is None:
+        return {"success": False, "message": "Order not found"}, 404
+    if not applied:
+        return {"success": False, "message": f"Order #{order_id} is already {order['status']}", "status": order['status']}, 409
+    notify_clients(order_id, changed, order=order, conn=conn) # Emit specific order update
     return {"success": True}
 
-@app.route("/api/orders/<int:order_id>/progress", methods=["GET"])
+@bp.route("/api/orders/<int:order_id>/ready", methods=["POST"])
+def mark_ready(order_id):
+    with db.write_transaction() as conn:
+        applied, order = db.transition_order(order_id, 'ready', conn)
+        return transition_response(order_id, applied, order, ['status'], conn)
+
+@bp.route("/api/orders/<int:order_id>/progress", methods=["GET"])
 def get_progress(order_id):
     progress = db.get_progress(order_id)
     return jsonify(progress)
 
-@app.route("/api/orders/<int:order_id>/progress", methods=["POST"])
+@bp.route("/api/orders/<int:order_id>/progress", methods=["POST"])
 def update_progress(order_id):
     data = request.json
-    ingredient = data["ingredient"]
-    checked = data["checked"]
-    
-    conn = db.get_db_connection()
-    order = db.get_order_by_id(order_id)
-    if order and order['status'] == 'pending':
-        conn.execute('UPDATE orders SET status = "preparing" WHERE id = ?', (order_id,))
-    
-    conn.execute('DELETE FROM order_progress WHERE order_id = ? AND ingredient = ?', (order_id, ingredient))
-    if checked:
-        conn.execute('INSERT INTO order_progress (order_id, ingredient, checked) VALUES (?, ?, ?)', (order_id, ingredient, 1))
-        
-    conn.commit()
-    conn.close()
-    notify_clients(order_id) # Emit specific order update
+    return apply_progress([(order_id, data["ingredient"], data["checked"])])
+
+@bp.route("/api/orders/progress", methods=["POST"])
+@admin_required
+def update_progress_batch():
+    """Record many ingredient ticks in one transaction.
+
+    Body: {"ticks": [{"order_id": 1, "ingredient": "cheese", "checked": true}, ...]}.
+    Each changed order gets a single update event. The kitchen page batches
+    a burst of taps into one request.
+    """
+    ticks = request.json.get("ticks", [])
+    return apply_progress([(tick["order_id"], tick["ingredient"], tick["checked"]) for tick in ticks])
+
+# Group commit of progress ticks: requests queue their ticks, and whichever
+# takes _progress_commit_lock first applies everything queued in one
+# transaction, including ticks that arrived while the previous batch committed
+_progress_lock = threading.Lock()
+_progress_commit_lock = threading.Lock()
+_progress_queue = []
+
+def apply_progress(ticks):
+    """ record (order id, ingredient key, checked) ticks and notify clients;
+    returns once they are committed, together with any concurrent ticks """
+    option_ids = db.get_option_map()
+    unknown = sorted({ingredient for _, ingredient, _ in ticks if ingredient not in option_ids})
+    if unknown:
+        return {"success": False, "message": f"Unknown ingredient: {', '.join(unknown)}"}, 400
+    by_order = {}
+    for order_id, ingredient, checked in ticks:
+        by_order.setdefault(order_id, []).append((option_ids[ingredient], bool(checked)))
+
+    entry = {'orders': by_order, 'done': threading.Event(), 'missing': None, 'error': None}
+    with _progress_lock:
+        _progress_queue.append(entry)
+    with _progress_commit_lock:
+        if not entry['done'].is_set():
+            commit_progress()
+    if entry['error']:
+        raise entry['error']
+    if entry['missing']:
+        return {"success": False, "message": f"Order not found: {entry['missing']}"}, 404
     return {"success": True}
 
-@app.route("/api/orders/<int:order_id>/start", methods=["POST"])
+def commit_progress():
+    """Applies every queued request's ticks in one transaction, with one
+    update event per changed order. A request naming a missing order is
+    rejected as a whole."""
+    with _progress_lock:
+        batch = _progress_queue[:]
+        _progress_queue.clear()
+    try:
+        with db.write_transaction() as conn:
+            exists = {}
+            merged = {}
+            for entry in batch:
+                for order_id in entry['orders']:
+                    if order_id not in exists:
+                        exists[order_id] = db.get_order_by_id(order_id, conn) is not None
+                    if not exists[order_id]:
+                        entry['missing'] = order_id
+                        break
+                else:
+                    for order_id, order_ticks in entry['orders'].items():
+                        # The latest tick of each ingredient wins
+                        merged.setdefault(order_id, {}).update(order_ticks)
+            for order_id, order_ticks in merged.items():
+                # The first tick on a pending order starts it
+                started, order = db.transition_order(order_id, 'preparing', conn)
+                db.set_progress(order_id, list(order_ticks.items()), conn)
+                notify_clients(order_id, ['status', 'progress'] if started else ['progress'], order=order, conn=conn) # Emit specific order update
+    except Exception as e:
+        for entry in batch:
+            entry['error'] = e
+        raise
+    finally:
+        for entry in batch:
+            entry['done'].set()
+
+@bp.route("/api/orders/<int:order_id>/start", methods=["POST"])
 def start_order(order_id):
-    conn = db.get_db_connection()
-    conn.execute('UPDATE orders SET status = "preparing" WHERE id = ?', (order_id,))
-    conn.commit()
-    conn.close()
-    notify_clients(order_id) # Emit specific order update
-    return {"success": True}
+    with db.write_transaction() as conn:
+        applied, order = db.transition_order(order_id, 'preparing', conn)
+        return transition_response(order_id, applied, order, ['status'], conn)
 
 
-@app.route("/api/orders/<int:order_id>/cancel", methods=["POST"])
+@bp.route("/api/orders/<int:order_id>/cancel", methods=["POST"])
 @admin_required
 def cancel_order(order_id):
-    conn = db.get_db_connection()
-    conn.execute('UPDATE orders SET status = "cancelled" WHERE id = ?', (order_id,))
-    conn.commit()
-    conn.close()
-    notify_clients(order_id)
-    return {"success": True}
+    with db.write_transaction() as conn:
+        applied, order = db.transition_order(order_id, 'cancelled', conn)
+        return transition_response(order_id, applied, order, ['status'], conn)
 
 
-@app.route("/api/delivery/ready-orders", methods=["GET"])
+@bp.route("/api/delivery/ready-orders", methods=["GET"])
 @login_required
 def get_ready_orders_for_delivery():
     orders = db.get_ready_orders_for_delivery()
     return jsonify(orders)
 
-@app.route("/api/delivery/my-deliveries", methods=["GET"])
+@bp.route("/api/delivery/my-deliveries", methods=["GET"])
 @login_required
 def get_my_deliveries():
-    deliveries = db.get_my_deliveries(session['user_id'])
+    deliveries = db.get_my_deliveries(current_user()['id'])
     return jsonify(deliveries)
 
-@app.route("/api/orders/<int:order_id>/collect", methods=["POST"])
+@bp.route("/api/orders/<int:order_id>/collect", methods=["POST"])
 @login_required
 def collect_order(order_id):
-    user = db.get_user_by_id(session['user_id'])
-    if not user:
-        return {"error": "User not found"}, 404
-
-    if not db.is_user_delivery(session['user_id']):
+    user = current_user()
+    if not user['is_delivery']:
         return {"error": "Only delivery users can collect orders"}, 403
 
-    conn = db.get_db_connection()
-    conn.execute('UPDATE orders SET status = "out_for_delivery", collected_by = ?, collected_at = ? WHERE id = ?',
-                 (user['name'], datetime.now().isoformat(), order_id))
-    conn.commit()
-    conn.close()
-    notify_clients(order_id) # Emit specific order update
-    return {"success": True}
+    # Only one rider can win the ready -> out_for_delivery transition
+    with db.write_transaction() as conn:
+        applied, order = db.transition_order(order_id, 'out_for_delivery', conn,
+                                             courier_id=user['id'], collected_by=user['name'], collected_at=datetime.now().isoformat())
+        return transition_response(order_id, applied, order, ['status', 'courier_id', 'collected_by', 'collected_at'], conn)
 
-@app.route("/api/orders/<int:order_id>/deliver", methods=["POST"])
+@bp.route("/api/orders/<int:order_id>/deliver", methods=["POST"])
 @login_required
 def deliver_order(order_id):
-    conn = db.get_db_connection()
-    conn.execute('UPDATE orders SET status = "delivered", delivered_at = ? WHERE id = ?',
-                 (datetime.now().isoformat(), order_id))
-    
-    order_to_deliver = db.get_order_by_id(order_id)
-    if order_to_deliver:
-        users = db.get_users()
-        user = next((u for u in users if u['name'] == order_to_deliver['name']), None)
-        if user:
-            conn.execute("INSERT OR REPLACE INTO order_settings (setting, value) VALUES (?, ?)", (f"user_{user['id']}", 1))
-
-    conn.commit()
-    conn.close()
-    notify_clients(order_id) # Emit specific order update
-    notify_clients() # Emit general update as well, as delivered orders might affect overall counts or history
-    return {"success": True}
+    with db.write_transaction() as conn:
+        applied, order = db.transition_order(order_id, 'delivered', conn, delivered_at=datetime.now().isoformat())
+        if applied:
+            # Delivery re-enables ordering for the order's owner and counts towards order_count
+            if order['user_id']:
+                db.record_delivery(order['user_id'], conn)
+
+        # The owner's page refetches its status, picking up re-enabled ordering
+        return transition_response(order_id, applied, order, ['status', 'delivered_at'], conn)
 
-@app.route("/api/orders/delivered", methods=["GET"])
+@bp.route("/api/orders/delivered", methods=["GET"])
 @login_required
 def get_delivered_orders():
-    orders = db.get_delivered_orders()
+    """The latest delivered orders, newest first; ?limit= (default 20)."""
+    limit = max(1, min(request.args.get('limit', 20, type=int), MAX_ORDERS_PAGE))
+    orders = db.get_delivered_orders(limit=limit)
     return jsonify(orders)
 
-@app.route("/api/user/order-history", methods=["GET"])
+@bp.route("/api/user/order-history", methods=["GET"])
 @login_required
 def get_user_order_history():
-    history = db.get_user_order_history(session['user_id'])
+    history = db.get_user_order_history(current_user()['id'])
     return jsonify(history)
 
-@app.route("/api/user/order-status", methods=["GET"])
+@bp.route("/api/user/order-status", methods=["GET"])
 def get_user_order_status():
-    user_id = session.get('user_id')
-    if not user_id:
-        return {"error": "Not authenticated"}, 401
-    
-    user = db.get_user_by_id(user_id)
+    user = current_user()
     if not user:
-        return {"error": "User not found"}, 404
-    
-    can_order = db.can_user_order(user_id)
-    current_order = db.get_user_current_order(user_id)
+        return {"error": "Not authenticated"}, 401
     
-    return jsonify({
-        "can_order": can_order,
-        "current_order": current_order,
+    return jsonify(order_status(user['id']))
+
+def order_status(user_id, conn=None):
+    user = db.get_user_by_id(user_id, conn)
+    return {
+        "can_order": db.can_user_order(user_id, conn),
+        "current_order": db.get_user_current_order(user_id, conn),
         "user_name": user.get("name")
-    })
+    }
 
-@app.route("/api/ingredients", methods=["GET"])
+@bp.route("/api/ingredients", methods=["GET"])
 def get_ingredients():
     return jsonify(db.get_ingredients())
 
-@app.route("/api/ingredients", methods=["POST"])
+@bp.route("/api/ingredients", methods=["POST"])
 @admin_required
 def add_ingredient():
     data = request.json
-    conn = db.get_db_connection()
-    cursor = conn.cursor()
-    # Include description when inserting
-    cursor.execute("INSERT INTO ingredients (name, category, emoji, image_url, description) VALUES (?, ?, ?, ?, ?)",
-                   (data["name"], data["category"], data.get("emoji", ""), data.get("image_url", ""), data.get("description", "")))
-    new_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with db.write_transaction() as conn:
+        cursor = conn.cursor()
+        # Include description when inserting
+        cursor.execute("INSERT INTO ingredients (name, category, emoji, image_url, description) VALUES (?, ?, ?, ?, ?)",
+                       (data["name"], data["category"], data.get("emoji", ""), data.get("image_url", ""), data.get("description", "")))
+        new_id = cursor.lastrowid
+        db.invalidate_cache('ingredients', conn)
+        notify_clients(rooms=['kitchen', 'admin'], conn=conn)
     
     new_ingredient = db.get_ingredients() # a bit inefficient but fine for now
     new_ingredient = next((ing for ing in new_ingredient if ing['id'] == new_id), None)
-    notify_clients()
 
     return {"success": True, "ingredient": new_ingredient}
 
-@app.route("/api/ingredients/<int:ingredient_id>", methods=["PUT"])
+@bp.route("/api/ingredients/<int:ingredient_id>", methods=["PUT"])
 @admin_required
 def update_ingredient(ingredient_id):
     data = request.json
-    conn = db.get_db_connection()
-    conn.execute("UPDATE ingredients SET name = ?, category = ?, emoji = ?, image_url = ?, description = ?, available_to = ? WHERE id = ?",
-                   (data["name"], data["category"], data.get("emoji", ""), data.get("image_url", ""), data.get("description", ""), data.get("available_to", "all"), ingredient_id))
-    conn.commit()
-    conn.close()
-    notify_clients()
+    with db.write_transaction() as conn:
+        conn.execute("UPDATE ingredients SET name = ?, category = ?, emoji = ?, image_url = ?, description = ?, available_to = ? WHERE id = ?",
+                       (data["name"], data["category"], data.get("emoji", ""), data.get("image_url", ""), data.get("description", ""), data.get("available_to", "all"), ingredient_id))
+        db.invalidate_cache('ingredients', conn)
+        notify_clients(rooms=['kitchen', 'admin'], conn=conn)
     return {"success": True}
 
-@app.route("/api/ingredients/<int:ingredient_id>", methods=["DELETE"])
+@bp.route("/api/ingredients/<int:ingredient_id>", methods=["DELETE"])
 @admin_required
 def delete_ingredient(ingredient_id):
-    conn = db.get_db_connection()
-    conn.execute("DELETE FROM ingredients WHERE id = ?", (ingredient_id,))
-    conn.commit()
-    conn.close()
-    notify_clients()
+    with db.write_transaction() as conn:
+        conn.execute("DELETE FROM ingredients WHERE id = ?", (ingredient_id,))
+        db.invalidate_cache('ingredients', conn)
+        notify_clients(rooms=['kitchen', 'admin'], conn=conn)
     return {"success": True}
 
 
 
-@app.route("/api/users", methods=["GET"])
+@bp.route("/api/users", methods=["GET"])
 @admin_required
 def get_users():
     users = db.get_users()
-    return jsonify([{k: v for k, v in u.items() if k != 'password'} for u in users])
+    return jsonify([{k: v for k, v in u.items() if k not in ('password', 'session_version')} for u in users])
 
-@app.route("/api/users", methods=["POST"])
+@bp.route("/api/users", methods=["POST"])
 @admin_required
 def add_user():
     data = request.json
     is_delivery = 1 if data.get("is_delivery") == 'True' else 0
-    conn = db.get_db_connection()
-    conn.execute("INSERT INTO users (username, password, role, name, gender, is_delivery) VALUES (?, ?, ?, ?, ?, ?)",
-                   (data["username"], "", data.get("role", "user"), data["name"], data.get("gender", "male"), is_delivery))
-    conn.commit()
-    conn.close()
-    notify_clients()
+    with db.write_transaction() as conn:
+        conn.execute("INSERT INTO users (username, password, role, name, gender, is_delivery) VALUES (?, ?, ?, ?, ?, ?)",
+                       (data["username"], "", data.get("role", "user"), data["name"], data.get("gender", "male"), is_delivery))
+        db.invalidate_cache('users', conn)
+        notify_clients(rooms=['admin'], conn=conn)
     return {"success": True}
 
-@app.route("/api/users/<int:user_id>", methods=["DELETE"])
+@bp.route("/api/users/<int:user_id>", methods=["DELETE"])
 @admin_required
 def delete_user(user_id):
-    conn = db.get_db_connection()
-    conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
-    conn.commit()
-    conn.close()
-    notify_clients()
+    with db.write_transaction() as conn:
+        conn.execute("DELETE FROM users WHERE id = ?", (user_id,))
+        db.invalidate_cache('users', conn)
+        notify_clients(rooms=['admin'], conn=conn)
     return {"success": True}
 
 
-@app.route("/api/user/<int:user_id>/generate-qr")
+# Magic links are valid for an hour. A link with at least MAGIC_LINK_REUSE
+# left is handed out again, so the QR code and copied link for a user agree
+# and their rendered image can be cached.
+MAGIC_LINK_TTL = timedelta(minutes=60)
+MAGIC_LINK_REUSE = timedelta(minutes=45)
+
+def _reusable_link(row):
+    """The expiry of a stored link as a UNIX timestamp, or None when it has
+    less than MAGIC_LINK_REUSE left."""
+    if row is None:
+        return None
+    try:
+        _, signed_at = serializer().loads(row['token'], salt='magic-link', return_timestamp=True)
+    except Exception:
+        return None
+    expires = min(datetime.fromisoformat(row['expires_at']).timestamp(), (signed_at + MAGIC_LINK_TTL).timestamp())
+    if expires - datetime.now().timestamp() < MAGIC_LINK_REUSE.total_seconds():
+        return None
+    return expires
+
+def issue_magic_links(users, conn=None):
+    """ the current magic link of each user, issuing new ones in a single
+    transaction where needed
+    :param users: list of user dicts
+    :param conn: Connection object, defaults to the shared connection
+    :return: list of (token, link, expires) tuples in the same order,
+        expires as a UNIX timestamp; a user listed twice gets the same link
+    """
+    conn = conn or db.get_connection()
+    base_url = current_app.config['BASE_URL']
+    with db.write_transaction(conn):
+        current = db.get_magic_links({user['id'] for user in users}, conn)
+        issued, new_links = {}, []
+        for user in users:
+            if user['id'] in issued:
+                # Tokens are timestamped, so a second one this second would collide
+                continue
+            row = current.get(user['id'])
+            expires = _reusable_link(row)
+            if expires is not None:
+                token = row['token']
+            else:
+                token = serializer().dumps(user['username'], salt='magic-link')
+                expires_at = datetime.now() + MAGIC_LINK_TTL
+                expires = expires_at.timestamp()
+                new_links.append((user['id'], token, expires_at.isoformat()))
+            issued[user['id']] = (token, f"{base_url}/magic-login/{token}", expires)
+        db.replace_magic_links(new_links, conn)
+    return [issued[user['id']] for user in users]
+
+def magic_link_for(user, conn=None):
+    return issue_magic_links([user], conn)[0]
+
+def sweep_magic_links(app):
+    """Background task deleting expired magic links every
+    MAGIC_LINK_SWEEP_INTERVAL seconds (default 600)."""
+    interval = int(app.config['KITCHEN_CONFIG'].get('MAGIC_LINK_SWEEP_INTERVAL', 600))
+    while True:
+        with app.app_context():
+            try:
+                deleted = db.delete_expired_magic_links()
+                if deleted:
+                    app.logger.info("Deleted %d expired magic links", deleted)
+            except Exception:
+                # Keep sweeping; one failed pass must not end the task
+                app.logger.exception("Magic link sweep failed")
+        socketio.sleep(interval)
+
+def archive_finished_orders(app):
+    """Move delivered and cancelled orders older than ORDER_ARCHIVE_AGE hours
+    (default 24) into the archive tables, in batches.
+    :return: number of orders archived
+    """
+    age = float(app.config['KITCHEN_CONFIG'].get('ORDER_ARCHIVE_AGE', 24))
+    before = (datetime.now() - timedelta(hours=age)).isoformat()
+    archived = 0
+    while True:
+        moved = db.archive_orders(before)
+        archived += moved
+        if moved < 500:
+            break
+        socketio.sleep(0)  # Let requests waiting on the write lock in between batches
+    if archived:
+        notify_clients()
+    return archived
+
+def compact_event_log(app):
+    """Delete order_events older than EVENT_RETENTION hours (default 24).
+    :return: number of events deleted
+    """
+    retention = float(app.config['KITCHEN_CONFIG'].get('EVENT_RETENTION', 24))
+    return events.compact((datetime.now() - timedelta(hours=retention)).isoformat())
+
+def sweep_orders(app):
+    """Background task running archive_finished_orders and compact_event_log
+    every ORDER_ARCHIVE_INTERVAL seconds (default 3600)."""
+    interval = int(app.config['KITCHEN_CONFIG'].get('ORDER_ARCHIVE_INTERVAL', 3600))
+    while True:
+        with app.app_context():
+            try:
+                archived = archive_finished_orders(app)
+                if archived:
+                    app.logger.info("Archived %d finished orders", archived)
+                compacted = compact_event_log(app)
+                if compacted:
+                    app.logger.info("Compacted %d order events", compacted)
+            except Exception:
+                # Keep archiving; a failed pass or notification must not end the task
+                app.logger.exception("Order archiving failed")
+        socketio.sleep(interval)
+
+@bp.route("/api/user/<int:user_id>/generate-qr")
 @admin_required
 def generate_qr(user_id):
     user = db.get_user_by_id(user_id)
     if not user:
         return "User not found", 404
 
-    # Generate a magic link
-    token = s.dumps(user['username'], salt='magic-link')
-    magic_link = f"{BASE_URL}/magic-login/{token}"
-
-    # Delete existing tokens for this user and store the new token (60 minutes expiration)
-    conn = db.get_db_connection()
-    conn.execute("DELETE FROM magic_links WHERE user_id = ?", (user_id,))
-    conn.execute("INSERT INTO magic_links (user_id, token, expires_at) VALUES (?, ?, ?)",
-                 (user_id, token, (datetime.now() + timedelta(minutes=60)).isoformat()))
-    conn.commit()
-    conn.close()
-
-    # Generate QR code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(magic_link)
-    qr.make(fit=True)
+    png = qr.get_png(*magic_link_for(user))
+    return send_file(BytesIO(png), mimetype='image/png')
 
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save QR code to a bytes buffer
+@bp.route("/api/users/qr-codes", methods=["POST"])
+@admin_required
+def generate_qr_codes():
+    """QR login codes for many users in one ZIP of <username>.png files.
+
+    Body: {"user_ids": [...]}, or no ids for every user. Links are issued in
+    one transaction and the missing images rendered in parallel.
+    """
+    user_ids = (request.get_json(silent=True) or {}).get('user_ids')
+    if user_ids is None:
+        users = db.get_users()
+    else:
+        # Each user once, however often their id is listed
+        users = list({user['id']: user for user in map(db.get_user_by_id, user_ids) if user}.values())
+    if not users:
+        return {"error": "No users found"}, 404
+
+    links = issue_magic_links(users)
     buf = BytesIO()
-    img.save(buf)
+    with zipfile.ZipFile(buf, 'w') as archive:
+        for user, png in zip(users, qr.get_pngs(links)):
+            archive.writestr(f"{user['username']}.png", png)
     buf.seek(0)
+    return send_file(buf, mimetype='application/zip', as_attachment=True, download_name='qr-codes.zip')
 
-    return send_file(buf, mimetype='image/png')
+@bp.route("/api/users/magic-links", methods=["POST"])
+@admin_required
+def get_magic_links():
+    """Magic links for many users, issued in one transaction.
 
+    Body: {"user_ids": [...]}, or no ids for every user.
+    """
+    user_ids = (request.get_json(silent=True) or {}).get('user_ids')
+    if user_ids is None:
+        users = db.get_users()
+    else:
+        # Each user once, however often their id is listed
+        users = list({user['id']: user for user in map(db.get_user_by_id, user_ids) if user}.values())
 
-@app.route("/api/user/<int:user_id>/magic-link")
+    links = issue_magic_links(users)
+    return jsonify([
+        {"user_id": user['id'], "user_name": user['name'], "magic_link": link,
+         "expires_at": datetime.fromtimestamp(expires).isoformat()}
+        for user, (_, link, expires) in zip(users, links)
+    ])
+
+@bp.route("/api/user/<int:user_id>/magic-link")
 @admin_required
 def get_magic_link(user_id):
     user = db.get_user_by_id(user_id)
     if not user:
         return {"error": "User not found"}, 404
 
-    # Generate a magic link
-    token = s.dumps(user['username'], salt='magic-link')
-    magic_link = f"{BASE_URL}/magic-login/{token}"
-
-    # Delete existing tokens for this user and store the new token (60 minutes expiration)
-    conn = db.get_db_connection()
-    conn.execute("DELETE FROM magic_links WHERE user_id = ?", (user_id,))
-    conn.execute("INSERT INTO magic_links (user_id, token, expires_at) VALUES (?, ?, ?)",
-                 (user_id, token, (datetime.now() + timedelta(minutes=60)).isoformat()))
-    conn.commit()
-    conn.close()
-
+    _, magic_link, _ = magic_link_for(user)
     return {"magic_link": magic_link, "user_name": user['name']}
 
-    # Generate QR code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(magic_link)
-    qr.make(fit=True)
-
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save QR code to a bytes buffer
-    buf = BytesIO()
-    img.save(buf)
-    buf.seek(0)
-
-    return send_file(buf, mimetype='image/png')
-
 
-@app.route('/magic-login/<token>')
+@bp.route('/magic-login/<token>')
 def magic_login(token):
     try:
-        username = s.loads(token, salt='magic-link', max_age=3600)  # 60 minutes
+        username = serializer().loads(token, salt='magic-link', max_age=MAGIC_LINK_TTL.total_seconds())
     except:
         return 'The magic link is expired or invalid.', 403
 
-    conn = db.get_db_connection()
-    magic_link_record = conn.execute('SELECT * FROM magic_links WHERE token = ?', (token,)).fetchone()
-    
+    # The stored link is deleted as it is checked (one-time use)
+    magic_link_record = db.consume_magic_link(token)
+    qr.discard(token)
     if not magic_link_record:
-        conn.close()
         return 'Invalid magic link.', 403
 
-    # Delete the token after validating it (one-time use)
-    conn.execute('DELETE FROM magic_links WHERE token = ?', (token,))
-    conn.commit()
-    conn.close()
-
     user = db.get_user_by_username(username)
 
     if user:
+        session.clear()
         session['user_id'] = user['id']
+        session['user_version'] = user['session_version']
         session['username'] = user['username']
         session['role'] = user['role']
         session['name'] = user['name']
-        return redirect(url_for('order_page'))
+        return redirect(url_for('kitchen.order_page'))
     else:
         return 'User not found.', 404
 
-@app.route("/api/order-settings", methods=["GET"])
+@bp.route("/api/order-settings", methods=["GET"])
 @admin_required
 def get_order_settings():
     settings = db.get_order_settings()
@@ -509,92 +940,101 @@ def get_order_settings():
             "name": user["name"],
             "gender": user.get("gender", ""),
             "role": user.get("role", ""),                # added role for UI clarity
-            "can_order": settings.get(f"user_{user['id']}", False)
+            "can_order": settings[user['id']]
         })
     return jsonify({
         "users": user_settings
     })
 
-@app.route("/api/order-settings", methods=["POST"])
+@bp.route("/api/order-settings", methods=["POST"])
 @admin_required
 def update_order_settings():
     data = request.json
-    conn = db.get_db_connection()
-    
-    if "toggle_category" in data:
-        category = data["toggle_category"]
-        enabled = 1 if data.get("enabled", False) else 0
-        users = db.get_users()
-
-        if category == "all":
-            # Apply to ALL users, including admins
-            for user in users:
-                conn.execute("INSERT OR REPLACE INTO order_settings (setting, value) VALUES (?, ?)", (f"user_{user['id']}", enabled))
-        else:
-            # Apply to all users matching the gender category (including admins)
-            for user in users:
-                if user.get('gender') == category:
-                    conn.execute("INSERT OR REPLACE INTO order_settings (setting, value) VALUES (?, ?)", (f"user_{user['id']}", enabled))
-
-    if "user_id" in data:
-        enabled = 1 if data.get("enabled", False) else 0
-        conn.execute("INSERT OR REPLACE INTO order_settings (setting, value) VALUES (?, ?)", (f"user_{data['user_id']}", enabled))
-
-    conn.commit()
-    conn.close()
-    notify_clients()
+    # Admin screens plus every user whose ordering permission changed
+    rooms = ['admin']
+
+    with db.write_transaction() as conn:
+        if "toggle_category" in data:
+            category = data["toggle_category"]
+            enabled = data.get("enabled", False)
+            if category == "all":
+                # Apply to ALL users, including admins
+                db.set_can_order(enabled, conn=conn)
+                rooms = None
+            else:
+                # Apply to all users matching the gender category (including admins)
+                user_ids = db.set_can_order(enabled, gender=category, conn=conn)
+                rooms += [f"user:{user_id}" for user_id in user_ids]
+
+        if "user_id" in data:
+            db.set_can_order(data.get("enabled", False), user_id=data['user_id'], conn=conn)
+            if rooms is not None:
+                rooms.append(f"user:{data['user_id']}")
+
+        notify_clients(rooms=rooms, conn=conn)
     return {"success": True}
 
-@app.route("/api/orders/clear-all", methods=["POST"])
+@bp.route("/api/cache-stats", methods=["GET"])
+@admin_required
+def get_cache_stats():
+    return jsonify(db.get_cache_stats())
+
+@bp.route("/api/orders/clear-all", methods=["POST"])
 @admin_required
 def clear_all_orders():
     try:
-        conn = db.get_db_connection()
-        
-        # Delete all order-related data
-        conn.execute("DELETE FROM order_progress")
-        conn.execute("DELETE FROM order_ingredients")
-        conn.execute("DELETE FROM orders")
-        
-        # Reset the auto-increment counter for orders table
-        conn.execute("DELETE FROM sqlite_sequence WHERE name='orders'")
-        
-        conn.commit()
-        conn.close()
-        
-        notify_clients()
+        with db.write_transaction() as conn:
+            # Delete all order-related data
+            conn.execute("DELETE FROM order_progress")
+            conn.execute("DELETE FROM order_ingredients")
+            conn.execute("DELETE FROM orders")
+            db.clear_archive(conn)
+
+            # Reset the auto-increment counter for orders table
+            conn.execute("DELETE FROM sqlite_sequence WHERE name='orders'")
+
+            notify_clients(conn=conn)
         return {"success": True, "message": "All orders cleared successfully"}
     except Exception as e:
         return {"success": False, "message": str(e)}, 500
 
 
-@app.route("/api/orders/clear-cancelled", methods=["POST"])
+@bp.route("/api/orders/clear-cancelled", methods=["POST"])
 @login_required
 def clear_cancelled_order():
-    user = db.get_user_by_id(session['user_id'])
-    if not user:
-        return {"success": False, "message": "User not found"}, 404
-
-    conn = db.get_db_connection()
-    # Find the user's cancelled order
-    order = conn.execute('SELECT * FROM orders WHERE name = ? AND status = "cancelled"', (user['name'],)).fetchone()
-    if order:
-        conn.execute("DELETE FROM order_progress WHERE order_id = ?", (order['id'],))
-        conn.execute("DELETE FROM order_ingredients WHERE order_id = ?", (order['id'],))
-        conn.execute("DELETE FROM orders WHERE id = ?", (order['id'],))
-        conn.commit()
-    conn.close()
-    notify_clients()
+    user_id = current_user()['id']
+    with db.write_transaction() as conn:
+        # Find the user's cancelled order
+        order = conn.execute('SELECT id FROM orders WHERE user_id = ? AND status = "cancelled"', (user_id,)).fetchone()
+        if order:
+            conn.execute("DELETE FROM order_progress WHERE order_id = ?", (order['id'],))
+            conn.execute("DELETE FROM order_ingredients WHERE order_id = ?", (order['id'],))
+            conn.execute("DELETE FROM orders WHERE id = ?", (order['id'],))
+            notify_clients(order['id'], ['deleted'], rooms=['kitchen', f"user:{user_id}"], conn=conn)
     return {"success": True}
 
 
 @socketio.on('connect')
 def handle_connect():
+    rooms = client_rooms(current_user())
+    for room in rooms:
+        join_room(room)
+    kind = next((kind for kind in ('kitchen', 'delivery') if kind in rooms), 'customer' if rooms else 'anonymous')
+    metrics.client_connected(request.sid, kind)
     print('Client connected')
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    metrics.client_disconnected(request.sid)
     print('Client disconnected')
 
 if __name__ == "__main__":
-    socketio.run(app, host="0.0.0.0", port=5001, debug=True, allow_unsafe_werkzeug=True)
+    # Development server; use serve.py in production
+    config = load_config()
+    app = create_app(config, check_schema=False)
+    with app.app_context():
+        init_db()
+    socketio.start_background_task(sweep_magic_links, app)
+    socketio.start_background_task(sweep_orders, app)
+    socketio.run(app, host=config.get('HOST', '0.0.0.0'), port=int(config.get('PORT', 5001)),
+                 debug=True, allow_unsafe_werkzeug=True)
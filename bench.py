@@ -0,0 +1,314 @@
+"""Dinner-rush benchmark for the order lifecycle.
+
+Runs the real routes through the Flask and Socket.IO test clients against a
+temporary SQLite file: customers place orders and poll their status, kitchen
+screens start, tick and ready them, and riders collect and deliver them.
+Latency percentiles, throughput, SQLite lock waits and websocket fan-out are
+written as JSON so runs can be compared between commits:
+
+    python bench.py --users 50 --kitchens 3 --riders 5 --output before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+
+class Recorder:
+    """Thread-safe latency and error samples keyed by endpoint label."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.conflicts = defaultdict(int)
+        self.lock_waits = []
+        self.lock_errors = 0
+        self.event_labels = {}  # event seq -> label of the request that published it
+        self.current = threading.local()
+
+    def request(self, label, started, status):
+        with self.lock:
+            self.latencies[label].append(time.perf_counter() - started)
+            if status == 409:
+                self.conflicts[label] += 1
+            elif status >= 400:
+                self.errors[label] += 1
+
+    def published(self, event):
+        with self.lock:
+            self.event_labels[event['seq']] = getattr(self.current, 'label', None)
+
+
+recorder = Recorder()
+
+
+class LockTimingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if _verb(sql) == 'BEGIN':
+            return _timed_lock(lambda: super(LockTimingCursor, self).execute(sql, parameters))
+        _begin_immediate(self.connection, sql)
+        return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        _begin_immediate(self.connection, sql)
+        return super().executemany(sql, seq_of_parameters)
+
+
+class LockTimingConnection(sqlite3.Connection):
+    """Opens write transactions with a timed BEGIN IMMEDIATE.
+
+    The write lock is taken when a transaction first writes, so timing an
+    explicit BEGIN IMMEDIATE at that point measures exactly the time spent
+    waiting for other writers. Explicit BEGIN statements are timed as is.
+    """
+
+    def cursor(self, factory=LockTimingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _verb(sql):
+    return sql.lstrip().split(None, 1)[0].upper()
+
+
+def _begin_immediate(conn, sql):
+    if not conn.in_transaction and _verb(sql) in ('INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+        _timed_lock(lambda: sqlite3.Connection.execute(conn, 'BEGIN IMMEDIATE'))
+
+
+def _timed_lock(begin):
+    started = time.perf_counter()
+    try:
+        return begin()
+    except sqlite3.OperationalError:
+        with recorder.lock:
+            recorder.lock_errors += 1
+        raise
+    finally:
+        with recorder.lock:
+            recorder.lock_waits.append(time.perf_counter() - started)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(samples, elapsed):
+    return {
+        "count": len(samples),
+        "throughput_per_s": round(len(samples) / elapsed, 2) if elapsed else None,
+        "p50_ms": _ms(percentile(samples, 50)),
+        "p95_ms": _ms(percentile(samples, 95)),
+        "p99_ms": _ms(percentile(samples, 99)),
+        "max_ms": _ms(max(samples) if samples else None),
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class Actor:
+    """One simulated person: a logged-in HTTP client plus a websocket."""
+
+    def __init__(self, app, socketio, user_id):
+        self.http = app.test_client()
+        with self.http.session_transaction() as sess:
+            sess['user_id'] = user_id
+        self.socket = socketio.test_client(app, flask_test_client=self.http)
+
+    def call(self, method, path, label, **kwargs):
+        # The test client runs the view on this thread, so events it publishes are attributed to label
+        recorder.current.label = label
+        started = time.perf_counter()
+        try:
+            response = getattr(self.http, method)(path, **kwargs)
+        finally:
+            recorder.current.label = None
+        recorder.request(label, started, response.status_code)
+        return response
+
+
+def run_customer(actor, name, options, deadline):
+    actor.call('post', '/api/orders', 'POST /api/orders', json=dict(options, name=name))
+    while time.monotonic() < deadline:
+        status = actor.call('get', '/api/user/order-status', 'GET /api/user/order-status').get_json()
+        if not status.get('current_order'):
+            return
+        time.sleep(random.uniform(0.2, 0.5))
+
+
+def run_kitchen(actor, remaining, deadline):
+    while remaining() and time.monotonic() < deadline:
+        orders = actor.call('get', '/api/orders?status=pending,preparing', 'GET /api/orders').get_json() or []
+        if not orders:
+            time.sleep(0.05)
+            continue
+        order = random.choice(orders)
+        if order['status'] == 'pending':
+            actor.call('post', f"/api/orders/{order['id']}/start", 'POST /api/orders/<id>/start')
+        for key in [k for k, v in order.items() if v == "True"]:
+            actor.call('post', f"/api/orders/{order['id']}/progress", 'POST /api/orders/<id>/progress',
+                       json={"ingredient": key, "checked": True})
+        actor.call('post', f"/api/orders/{order['id']}/ready", 'POST /api/orders/<id>/ready')
+
+
+def run_rider(actor, remaining, deadline):
+    while remaining() and time.monotonic() < deadline:
+        ready = actor.call('get', '/api/delivery/ready-orders', 'GET /api/delivery/ready-orders').get_json() or []
+        if not ready:
+            time.sleep(0.05)
+            continue
+        order = random.choice(ready)
+        collected = actor.call('post', f"/api/orders/{order['id']}/collect", 'POST /api/orders/<id>/collect')
+        if collected.status_code == 200:
+            actor.call('post', f"/api/orders/{order['id']}/deliver", 'POST /api/orders/<id>/deliver')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=30, help='customers placing one order each')
+    parser.add_argument('--kitchens', type=int, default=2, help='kitchen screens preparing orders')
+    parser.add_argument('--riders', type=int, default=3, help='delivery riders')
+    parser.add_argument('--timeout', type=float, default=120.0, help='seconds before the run is abandoned')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help='SQLite file to use (default: a new temporary file)')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    tmpdir = tempfile.TemporaryDirectory()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as kitchen
+    import database as db
+    import events
+    app = kitchen.create_app({'DB_PATH': args.db or os.path.join(tmpdir.name, 'bench.db')}, check_schema=False)
+    with app.app_context(), contextlib.redirect_stdout(io.StringIO()):
+        kitchen.init_db()
+    app.config['DB_CONNECTION_FACTORY'] = LockTimingConnection
+    publish = events.publish
+
+    def recorded_publish(*args, **kwargs):
+        event = publish(*args, **kwargs)
+        recorder.published(event)
+        return event
+    events.publish = recorded_publish
+
+    # Seed customers and riders through the admin routes, then open ordering
+    with contextlib.redirect_stdout(io.StringIO()):
+        admin = Actor(app, kitchen.socketio, 1)
+    for i in range(args.users):
+        admin.http.post('/api/users', json={"username": f"customer{i}", "name": f"Customer {i}", "gender": random.choice(["male", "female", "kid"])})
+    for i in range(args.riders):
+        admin.http.post('/api/users', json={"username": f"rider{i}", "name": f"Rider {i}", "is_delivery": "True"})
+    admin.http.post('/api/order-settings', json={"toggle_category": "all", "enabled": True})
+    users = {u['username']: u['id'] for u in admin.http.get('/api/users').get_json()}
+    option_keys = [ing['name'].lower().replace(' ', '_') for ing in admin.http.get('/api/ingredients').get_json()]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        customers = [Actor(app, kitchen.socketio, users[f"customer{i}"]) for i in range(args.users)]
+        riders = [Actor(app, kitchen.socketio, users[f"rider{i}"]) for i in range(args.riders)]
+        kitchens = [Actor(app, kitchen.socketio, 1) for _ in range(args.kitchens)]
+    recorder.latencies.clear()
+    recorder.errors.clear()
+    recorder.conflicts.clear()
+    recorder.lock_waits.clear()
+    with app.app_context():
+        first_seq = events.last_seq()
+
+    def remaining():
+        with app.app_context():
+            return bool(db.get_orders(statuses=['pending', 'preparing', 'ready', 'out_for_delivery'])) or any(t.is_alive() for t in customer_threads)
+
+    deadline = time.monotonic() + args.timeout
+    started = time.perf_counter()
+    customer_threads = [
+        threading.Thread(target=run_customer, args=(actor, f"Customer {i}", {k: True for k in random.sample(option_keys, 4)}, deadline))
+        for i, actor in enumerate(customers)
+    ]
+    worker_threads = [threading.Thread(target=run_kitchen, args=(actor, remaining, deadline)) for actor in kitchens]
+    worker_threads += [threading.Thread(target=run_rider, args=(actor, remaining, deadline)) for actor in riders]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in customer_threads + worker_threads:
+            thread.start()
+        for thread in customer_threads + worker_threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+
+    fanout = defaultdict(int)
+    fanout_by_endpoint = defaultdict(lambda: defaultdict(int))
+    for actor in customers + riders + kitchens:
+        for message in actor.socket.get_received():
+            fanout[message['name']] += 1
+            label = recorder.event_labels.get(message['args'][0].get('seq')) or 'setup'
+            fanout_by_endpoint[label][message['name']] += 1
+    all_samples = [s for samples in recorder.latencies.values() for s in samples]
+    with app.app_context():
+        delivered = len(db.get_orders(statuses=['delivered']))
+        published = events.last_seq() - first_seq
+
+    results = {
+        "commit": git_commit(),
+        "run_at": datetime.now().isoformat(),
+        "params": {"users": args.users, "kitchens": args.kitchens, "riders": args.riders, "seed": args.seed},
+        "elapsed_s": round(elapsed, 3),
+        "orders_delivered": delivered,
+        "completed": delivered == args.users,
+        "overall": summarize(all_samples, elapsed),
+        "endpoints": {
+            label: dict(summarize(samples, elapsed), errors=recorder.errors[label], conflicts=recorder.conflicts[label])
+            for label, samples in sorted(recorder.latencies.items())
+        },
+        "sqlite": {
+            "write_transactions": len(recorder.lock_waits),
+            "lock_wait_total_ms": _ms(sum(recorder.lock_waits)),
+            "lock_wait_p95_ms": _ms(percentile(recorder.lock_waits, 95)),
+            "lock_wait_max_ms": _ms(max(recorder.lock_waits) if recorder.lock_waits else None),
+            "lock_errors": recorder.lock_errors,
+        },
+        "websocket": {
+            "events_published": published,
+            "messages_received": dict(fanout),
+            "messages_by_endpoint": {label: dict(counts) for label, counts in sorted(fanout_by_endpoint.items())},
+            "messages_per_event": round(sum(fanout.values()) / max(1, published), 2),
+            "connected_clients": len(customers) + len(riders) + len(kitchens),
+        },
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({k: results[k] for k in ("elapsed_s", "orders_delivered", "overall", "sqlite", "websocket")}, indent=2))
+    print(f"Full results written to {args.output}")
+    tmpdir.cleanup()
+    return 0 if results["completed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,142 @@
+import hashlib
 import sqlite3
 import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app, g, has_app_context
 
 DB_FILE = "kitchen.db" # Default DB file
 
+# Pragmas applied once to every new connection, overridable from config.properties
+# with DB_<PRAGMA> keys (e.g. DB_SYNCHRONOUS=NORMAL)
+PRAGMAS = {
+    'journal_mode': 'WAL',  # WAL mode for better concurrency
+    'synchronous': 'FULL',
+    'cache_size': -8000,    # negative values are KiB
+    'mmap_size': 0,
+    'busy_timeout': 10000,  # milliseconds
+}
+
+# sqlite3.Connection subclass used for every connection. Tools that need to
+# observe queries set DB_CONNECTION_FACTORY in their app's config instead
+# (see metrics.py and bench.py); this default applies outside app contexts
+connection_factory = sqlite3.Connection
+
+# Connection reused by the current thread when there is no Flask app context
+_local = threading.local()
+
 def set_db_file(path):
     global DB_FILE
     DB_FILE = path
+    _close_thread_connection()
+
+def db_file():
+    """ the current app's DB_PATH inside an app context, DB_FILE otherwise """
+    if has_app_context():
+        return current_app.config.get('DB_PATH', DB_FILE)
+    return DB_FILE
+
+def _connection_factory():
+    """ the current app's DB_CONNECTION_FACTORY inside an app context, connection_factory otherwise """
+    if has_app_context():
+        return current_app.config.get('DB_CONNECTION_FACTORY', connection_factory)
+    return connection_factory
+
+def configure(config):
+    """ apply DB_* pragma overrides from the loaded config.properties
+    :param config: dict of config keys to values
+    :return:
+    """
+    for name in PRAGMAS:
+        value = config.get(f"DB_{name.upper()}")
+        if value:
+            PRAGMAS[name] = value
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_FILE, timeout=10.0)
+    """ open a new connection with the configured pragmas applied
+    :return: Connection object, owned (and closed) by the caller
+    """
+    conn = sqlite3.connect(db_file(), timeout=int(PRAGMAS['busy_timeout']) / 1000, factory=_connection_factory())
     conn.row_factory = sqlite3.Row
-    # Enable WAL mode for better concurrency
-    conn.execute('PRAGMA journal_mode=WAL')
+    for name, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+def get_connection():
+    """ return the connection shared by the current Flask request, or by the
+    current thread outside of an app context. Callers must not close it.
+    :return: Connection object
+    """
+    if has_app_context():
+        if 'db_conn' not in g:
+            g.db_conn = get_db_connection()
+        return g.db_conn
+
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = get_db_connection()
     return conn
 
+def close_connection(exception=None):
+    # Anything left uncommitted by a failed request is rolled back by close()
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.close()
+
+def _close_thread_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def init_app(app):
+    app.teardown_appcontext(close_connection)
+
+@contextmanager
+def write_transaction(conn=None):
+    """ run the block in one BEGIN IMMEDIATE transaction, committing at the end
+    or rolling back on error. Taking the write lock up front means concurrent
+    writers queue on busy_timeout instead of failing when they upgrade.
+    Nested use joins the transaction that is already open.
+    :param conn: Connection object, defaults to the shared connection
+    :return: the connection
+    """
+    conn = conn or get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    callbacks = _after_commit[id(conn)] = []
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        _after_commit.pop(id(conn), None)
+    conn.commit()
+    for callback in callbacks:
+        callback()
+
+_after_commit = {}  # id(connection) -> callbacks for its open write_transaction
+
+def after_commit(conn, callback):
+    """ run callback once the write_transaction open on conn commits, e.g. to
+    emit an event only when its change is visible; runs it now if none is open
+    and drops it if the transaction rolls back
+    :param conn: Connection object
+    :param callback: function taking no arguments
+    :return:
+    """
+    callbacks = _after_commit.get(id(conn))
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
+
 def create_table(conn, create_table_sql):
     """ create a table from the create_table_sql statement
     :param conn: Connection object
@@ -26,6 +149,197 @@ def create_table(conn, create_table_sql):
     except sqlite3.Error as e:
         print(e)
 
+def _add_column(conn, table, column, definition):
+    cols = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    if column not in [c[1] for c in cols]:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _migration_1(conn):
+    # Columns that older databases may lack but app.py already relies on
+    _add_column(conn, "ingredients", "description", "text DEFAULT ''")
+    _add_column(conn, "ingredients", "available_to", "text DEFAULT 'all'")
+    _add_column(conn, "users", "password", "text DEFAULT ''")
+
+def _migration_2(conn):
+    # Indexes for the per-status, per-user and per-rider order lookups
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_delivered_at ON orders (status, delivered_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_name_status_timestamp ON orders (name, status, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_collected_by_status ON orders (collected_by, status)")
+
+def _migration_3(conn):
+    # Version rows for the read-through cache; bumped by every admin write
+    conn.execute("""CREATE TABLE IF NOT EXISTS cache_versions (
+                        name text PRIMARY KEY,
+                        version integer NOT NULL DEFAULT 0
+                    )""")
+
+def _create_orders_version_triggers(conn, table):
+    for action in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_{action.lower()}_version AFTER {action} ON {table}
+                         BEGIN
+                             UPDATE cache_versions SET version = version + 1, updated_at = strftime('%Y-%m-%dT%H:%M:%S', 'now')
+                             WHERE name = 'orders';
+                         END""")
+
+def _migration_4(conn):
+    # Change counter for orders, kept by triggers so no write path can miss it
+    _add_column(conn, "cache_versions", "updated_at", "text")
+    conn.execute("INSERT OR IGNORE INTO cache_versions (name, version, updated_at) VALUES ('orders', 0, strftime('%Y-%m-%dT%H:%M:%S', 'now'))")
+    for table in ("orders", "order_ingredients"):
+        _create_orders_version_triggers(conn, table)
+
+def _migration_5(conn):
+    # magic_links looked up by a fixed-size SHA-256 of the token instead of a
+    # UNIQUE index on the token text; expired rows are not carried over
+    conn.execute("""CREATE TABLE magic_links_new (
+                        id integer PRIMARY KEY,
+                        user_id integer,
+                        token text NOT NULL,
+                        token_hash blob NOT NULL UNIQUE,
+                        expires_at timestamp,
+                        FOREIGN KEY (user_id) REFERENCES users (id)
+                    )""")
+    rows = conn.execute("SELECT user_id, token, expires_at FROM magic_links WHERE expires_at > ?",
+                        (datetime.now().isoformat(),)).fetchall()
+    conn.executemany("INSERT INTO magic_links_new (user_id, token, token_hash, expires_at) VALUES (?, ?, ?, ?)",
+                     [(row[0], row[1], hash_token(row[1]), row[2]) for row in rows])
+    conn.execute("DROP TABLE magic_links")
+    conn.execute("ALTER TABLE magic_links_new RENAME TO magic_links")
+    conn.execute("CREATE INDEX idx_magic_links_user_id ON magic_links (user_id)")
+    conn.execute("CREATE INDEX idx_magic_links_expires_at ON magic_links (expires_at)")
+
+def _migration_6(conn):
+    # Ordering permission as a typed users column instead of user_<id> rows in
+    # order_settings, so category toggles are one UPDATE
+    _add_column(conn, "users", "can_order", "integer NOT NULL DEFAULT 0")
+    conn.execute(r"""UPDATE users SET can_order = 1 WHERE id IN (
+                         SELECT CAST(substr(setting, 6) AS integer) FROM order_settings
+                         WHERE setting LIKE 'user\_%' ESCAPE '\' AND value)""")
+    conn.execute(r"DELETE FROM order_settings WHERE setting LIKE 'user\_%' ESCAPE '\'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_gender ON users (gender)")
+
+def _migration_7(conn):
+    # order_progress keyed by ingredient id instead of the option key text;
+    # progress is now part of /api/orders, so it moves the orders counter too
+    conn.execute("""CREATE TABLE order_progress_new (
+                        order_id integer NOT NULL,
+                        ingredient_id integer NOT NULL,
+                        checked integer NOT NULL DEFAULT 1,
+                        PRIMARY KEY (order_id, ingredient_id)
+                    ) WITHOUT ROWID""")
+    option_ids = _load_ingredients(conn)['option_ids']
+    rows = conn.execute("SELECT order_id, ingredient, checked FROM order_progress").fetchall()
+    conn.executemany("INSERT OR IGNORE INTO order_progress_new (order_id, ingredient_id, checked) VALUES (?, ?, ?)",
+                     [(row[0], option_ids[row[1]], row[2]) for row in rows if row[1] in option_ids])
+    conn.execute("DROP TABLE order_progress")
+    conn.execute("ALTER TABLE order_progress_new RENAME TO order_progress")
+    _create_orders_version_triggers(conn, "order_progress")
+
+def _migration_8(conn):
+    # Finished orders move to archive tables (see archive_orders) so orders
+    # only holds recent ones; delivered_count replaces counting a user's history
+    _add_column(conn, "users", "delivered_count", "integer NOT NULL DEFAULT 0")
+    conn.execute("""UPDATE users SET delivered_count = (
+                        SELECT COUNT(*) FROM orders WHERE orders.name = users.name AND orders.status = 'delivered')""")
+    conn.execute("""CREATE TABLE archived_orders (
+                        id integer PRIMARY KEY,
+                        name text,
+                        person_type text,
+                        order_count integer,
+                        additional_instructions text,
+                        status text,
+                        timestamp text,
+                        collected_by text,
+                        collected_at text,
+                        delivered_at text,
+                        archived_at text
+                    )""")
+    conn.execute("""CREATE TABLE archived_order_ingredients (
+                        order_id integer NOT NULL,
+                        ingredient_id integer NOT NULL,
+                        PRIMARY KEY (order_id, ingredient_id)
+                    ) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX idx_archived_orders_name_status ON archived_orders (name, status)")
+
+def _migration_9(conn):
+    # Append-only log of the events sent to clients, written in the same
+    # transaction as each change (see events.py)
+    conn.execute("""CREATE TABLE order_events (
+                        seq integer PRIMARY KEY AUTOINCREMENT,
+                        event text NOT NULL,
+                        order_id integer,
+                        rooms text,
+                        payload text NOT NULL,
+                        created_at text NOT NULL
+                    )""")
+    conn.execute("CREATE INDEX idx_order_events_created_at ON order_events (created_at)")
+
+def _migration_10(conn):
+    # Orders reference their owner and courier by id instead of matching
+    # name / collected_by against users.name; names stay for display
+    for table in ("orders", "archived_orders"):
+        _add_column(conn, table, "user_id", "integer REFERENCES users (id)")
+        _add_column(conn, table, "courier_id", "integer REFERENCES users (id)")
+        conn.execute(f"UPDATE {table} SET user_id = (SELECT MIN(id) FROM users WHERE users.name = {table}.name)")
+        conn.execute(f"""UPDATE {table} SET courier_id = (SELECT id FROM users WHERE users.name = {table}.collected_by
+                                                           ORDER BY is_delivery DESC, id LIMIT 1)
+                         WHERE collected_by IS NOT NULL""")
+    conn.execute("DROP INDEX IF EXISTS idx_orders_name_status_timestamp")
+    conn.execute("DROP INDEX IF EXISTS idx_orders_collected_by_status")
+    conn.execute("DROP INDEX IF EXISTS idx_archived_orders_name_status")
+    conn.execute("CREATE INDEX idx_orders_user_id_status ON orders (user_id, status)")
+    conn.execute("CREATE INDEX idx_orders_courier_id_status ON orders (courier_id, status)")
+    conn.execute("CREATE INDEX idx_archived_orders_user_id_status ON archived_orders (user_id, status)")
+
+def _migration_11(conn):
+    # Sessions record their user's session_version at login and are refused
+    # once it differs, e.g. after the user is deleted and the id reused. New
+    # users get a random stamp from the trigger.
+    _add_column(conn, "users", "session_version", "integer NOT NULL DEFAULT 0")
+    conn.execute("UPDATE users SET session_version = abs(random() % 1000000000) + 1")
+    conn.execute("""CREATE TRIGGER users_session_version AFTER INSERT ON users WHEN NEW.session_version = 0
+                    BEGIN
+                        UPDATE users SET session_version = abs(random() % 1000000000) + 1 WHERE id = NEW.id;
+                    END""")
+
+# Applied in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+    _migration_5,
+    _migration_6,
+    _migration_7,
+    _migration_8,
+    _migration_9,
+    _migration_10,
+    _migration_11,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """ run every migration newer than the database's user_version
+    :param conn: Connection object
+    :return: the schema version after migrating
+    """
+    version = get_schema_version(conn)
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        # Each migration and its version bump commit together
+        conn.execute('BEGIN')
+        try:
+            MIGRATIONS[target - 1](conn)
+            conn.execute(f'PRAGMA user_version = {target}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return max(version, SCHEMA_VERSION)
+
 def setup_database():
     conn = get_db_connection()
 
@@ -99,14 +413,7 @@ def setup_database():
         create_table(conn, create_order_progress_table_sql)
         create_table(conn, create_magic_links_table_sql)
 
-        # Ensure description column exists (migration for older DBs)
-        cols = conn.execute("PRAGMA table_info(ingredients)").fetchall()
-        col_names = [c[1] for c in cols]
-        if 'description' not in col_names:
-            try:
-                conn.execute("ALTER TABLE ingredients ADD COLUMN description text DEFAULT ''")
-            except Exception as e:
-                print("Failed to add description column:", e)
+        migrate(conn)
 
         # Check if database is empty
         cursor = conn.cursor()
@@ -115,8 +422,8 @@ def setup_database():
 
         if user_count == 0:
             # Add default admin
-            conn.execute("INSERT INTO users (id, username, role, name, gender, is_delivery) VALUES (?, ?, ?, ?, ?, ?)",
-                         (1, "admin", "admin", "Administrator", "admin", 0))
+            conn.execute("INSERT INTO users (id, username, password, role, name, gender, is_delivery) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (1, "admin", "", "admin", "Administrator", "admin", 0))
 
 
         cursor.execute("SELECT COUNT(*) FROM ingredients")
@@ -146,130 +453,403 @@ def setup_database():
         conn.commit()
         conn.close()
 
-def get_ingredients():
-    conn = get_db_connection()
-    ingredients = conn.execute('SELECT * FROM ingredients').fetchall()
-    conn.close()
-    return [dict(row) for row in ingredients]
-
-def get_users():
-    conn = get_db_connection()
-    users = conn.execute('SELECT * FROM users').fetchall()
-    conn.close()
-    return [dict(row) for row in users]
-
-def get_user_by_id(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    return dict(user) if user else None
-
+# Read-through cache for the tables that only change through admin edits.
+# Entries are keyed by the table's row in cache_versions: writers bump it with
+# invalidate_cache() in the same transaction, so every process notices a stale
+# copy on its next read. Values are shared between callers; treat as read-only.
+_cache = {}  # (db file, name) -> (version, value)
+cache_stats = {'hits': 0, 'misses': 0}
+
+def _cache_version(name, conn):
+    row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+    return row['version'] if row else 0
+
+def _cached(name, loader, conn=None):
+    conn = conn or get_connection()
+    entry = _cache.get((db_file(), name))
+    # Inside a request the version row is checked once per table
+    checked = g.setdefault('cache_checked', set()) if has_app_context() else set()
+    version = None
+    if entry is not None and name not in checked:
+        version = _cache_version(name, conn)
+        if entry[0] == version:
+            checked.add(name)
+    if entry is not None and name in checked:
+        cache_stats['hits'] += 1
+        return entry[1]
+
+    cache_stats['misses'] += 1
+    if version is None:
+        version = _cache_version(name, conn)
+    value = loader(conn)
+    _cache[(db_file(), name)] = (version, value)
+    checked.add(name)
+    return value
+
+def invalidate_cache(name, conn=None):
+    """ mark the cached copy of a table stale in every process; call inside
+    the transaction that changes the table, before committing
+    :param name: 'ingredients' or 'users'
+    :param conn: Connection object holding the write transaction
+    :return:
+    """
+    conn = conn or get_connection()
+    conn.execute("INSERT INTO cache_versions (name, version, updated_at) VALUES (?, 1, strftime('%Y-%m-%dT%H:%M:%S', 'now')) "
+                 "ON CONFLICT (name) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at", (name,))
+    _cache.pop((db_file(), name), None)
+    if has_app_context():
+        g.setdefault('cache_checked', set()).discard(name)
+
+def get_orders_version(conn=None):
+    """ the change counters of the order listings: orders, and ingredients,
+    whose option keys they are rendered with
+    :return: (orders version, ingredients version, UTC time either last moved) tuple
+    """
+    conn = conn or get_connection()
+    rows = {row['name']: row for row in conn.execute(
+        "SELECT name, version, updated_at FROM cache_versions WHERE name IN ('orders', 'ingredients')")}
+    versions = [rows[name]['version'] if name in rows else 0 for name in ('orders', 'ingredients')]
+    updated_at = max((row['updated_at'] for row in rows.values() if row['updated_at']), default=None)
+    return versions[0], versions[1], updated_at
+
+def get_cache_stats():
+    return dict(cache_stats, entries={name: version for (path, name), (version, _) in _cache.items() if path == db_file()})
+
+def _option_key(name):
+    return name.lower().replace(" ", "_")
+
+def _load_ingredients(conn):
+    ingredients = [dict(row) for row in conn.execute('SELECT * FROM ingredients ORDER BY id')]
+    option_ids = {}
+    for ing in ingredients:
+        # Keep the first ingredient if two names share an option key
+        option_ids.setdefault(_option_key(ing['name']), ing['id'])
+    return {'list': ingredients, 'option_ids': option_ids, 'option_keys': {i: key for key, i in option_ids.items()}}
+
+# Changed by every delivery, so read with direct queries instead: keeping them
+# in the snapshot would reload the users table in every process per delivery
+_VOLATILE_USER_COLUMNS = ('can_order', 'delivered_count')
+
+def _load_users(conn):
+    users = [{k: v for k, v in dict(row).items() if k not in _VOLATILE_USER_COLUMNS}
+             for row in conn.execute('SELECT * FROM users')]
+    return {
+        'list': users,
+        'by_id': {user['id']: user for user in users},
+        'by_username': {user['username']: user for user in users},
+    }
+
+def get_ingredients(conn=None):
+    return _cached('ingredients', _load_ingredients, conn)['list']
+
+def get_option_map(conn=None):
+    """ map each ingredient's option key (as posted by the order form) to its id """
+    return _cached('ingredients', _load_ingredients, conn)['option_ids']
+
+def get_users(conn=None):
+    return _cached('users', _load_users, conn)['list']
+
+def get_user_by_id(user_id, conn=None):
+    if user_id is None:
+        return None
+    return _cached('users', _load_users, conn)['by_id'].get(int(user_id))
 
 
 
-def get_user_by_username(username):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-    conn.close()
-    return dict(user) if user else None
 
+def get_user_by_username(username, conn=None):
+    return _cached('users', _load_users, conn)['by_username'].get(username)
 
-def get_orders():
-    conn = get_db_connection()
-    orders = conn.execute('SELECT * FROM orders').fetchall()
-    
-    orders_list = []
-    for o in orders:
-        order_dict = dict(o)
-        ingredients = get_order_ingredients(o['id'])
-        for ingredient in ingredients:
-            order_dict[ingredient['name'].lower().replace(' ', '_')] = "True"
-        orders_list.append(order_dict)
-    conn.close()
+def _load_orders(conn, where="", params=(), archived=False):
+    """ load orders matching the where clause together with their ingredients
+    :param conn: Connection object
+    :param where: SQL appended to the orders SELECT (WHERE / ORDER BY / LIMIT)
+    :param params: parameters for the where clause
+    :param archived: read archived_orders instead of orders
+    :return: list of order dicts with an ingredient_name: "True" entry per ingredient
+    """
+    orders_table, ingredients_table = ('archived_orders', 'archived_order_ingredients') if archived else ('orders', 'order_ingredients')
+    orders = conn.execute(f'SELECT * FROM {orders_table} {where}', params).fetchall()
+    orders_list = [dict(o) for o in orders]
+    if not orders_list:
+        return orders_list
+
+    # One set-based query for the ingredient flags of every loaded order
+    orders_by_id = {o['id']: o for o in orders_list}
+    ingredients = conn.execute(f'SELECT oi.order_id, i.name FROM {ingredients_table} oi JOIN ingredients i ON i.id = oi.ingredient_id '
+                               f'WHERE oi.order_id IN (SELECT id FROM {orders_table} {where})', params).fetchall()
+    for row in ingredients:
+        order_dict = orders_by_id.get(row['order_id'])
+        if order_dict is not None:
+            order_dict[row['name'].lower().replace(' ', '_')] = "True"
     return orders_list
 
-def get_order_ingredients(order_id):
-    conn = get_db_connection()
+def get_orders(conn=None, statuses=None, since=None, after_id=None, limit=None):
+    """ load orders, optionally filtered, in id order
+    :param statuses: only orders with one of these statuses
+    :param since: only orders placed at or after this ISO timestamp
+    :param after_id: keyset cursor, only orders with a larger id
+    :param limit: maximum number of orders
+    :return: list of order dicts
+    """
+    conn = conn or get_connection()
+    clauses, params = [], []
+    if statuses:
+        clauses.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params += statuses
+    if since:
+        clauses.append("timestamp >= ?")
+        params.append(since)
+    if after_id is not None:
+        clauses.append("id > ?")
+        params.append(after_id)
+    where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+    if limit is not None or after_id is not None:
+        where += "ORDER BY id"
+        if limit is not None:
+            where += " LIMIT ?"
+            params.append(limit)
+    return _load_orders(conn, where, tuple(params))
+
+# Every status an order can be in
+ORDER_STATUSES = ('pending', 'preparing', 'ready', 'out_for_delivery', 'delivered', 'cancelled')
+
+def get_status_counts(conn=None):
+    """ the number of orders in each status, from one GROUP BY over the status
+    index; archived orders are not counted
+    :return: dict of status to count, for every status in ORDER_STATUSES
+    """
+    conn = conn or get_connection()
+    counts = dict.fromkeys(ORDER_STATUSES, 0)
+    counts.update(conn.execute('SELECT status, COUNT(*) FROM orders GROUP BY status').fetchall())
+    return counts
+
+# The statuses an order may move to, and the statuses each may be reached from
+ORDER_TRANSITIONS = {
+    'preparing': ('pending',),
+    'ready': ('pending', 'preparing'),
+    'cancelled': ('pending', 'preparing', 'ready'),
+    'out_for_delivery': ('ready',),
+    'delivered': ('out_for_delivery',),
+}
+
+def transition_order(order_id, status, conn=None, **fields):
+    """ move an order to status with one conditional UPDATE, so concurrent
+    requests cannot both apply the same transition
+    :param order_id: id of the order
+    :param status: target status, a key of ORDER_TRANSITIONS
+    :param conn: Connection object; joins its open transaction if there is one
+    :param fields: other orders columns to set, e.g. courier_id
+    :return: (applied, order) where order is the order after the update, or
+             its current state on conflict (None if it does not exist)
+    """
+    from_statuses = ORDER_TRANSITIONS[status]
+    assignments = ', '.join(['status = ?'] + [f'{name} = ?' for name in fields])
+    with write_transaction(conn) as conn:
+        cursor = conn.execute(f'UPDATE orders SET {assignments} WHERE id = ? AND status IN ({", ".join("?" * len(from_statuses))})',
+                              (status, *fields.values(), order_id, *from_statuses))
+        return cursor.rowcount == 1, get_order_details(order_id, conn)
+
+def get_order_details(order_id, conn=None):
+    """ load one order with its ingredient flags, in the get_orders() shape """
+    conn = conn or get_connection()
+    orders = _load_orders(conn, 'WHERE id = ?', (order_id,))
+    return orders[0] if orders else None
+
+def get_order_ingredients(order_id, conn=None):
+    conn = conn or get_connection()
     ingredients = conn.execute('SELECT i.name FROM ingredients i JOIN order_ingredients oi ON i.id = oi.ingredient_id WHERE oi.order_id = ?', (order_id,)).fetchall()
-    conn.close()
     return [dict(row) for row in ingredients]
 
-def get_order_by_id(order_id):
-    conn = get_db_connection()
+def get_order_by_id(order_id, conn=None):
+    conn = conn or get_connection()
     order = conn.execute('SELECT * FROM orders WHERE id = ?', (order_id,)).fetchone()
-    conn.close()
     return dict(order) if order else None
 
-def get_order_settings():
-    conn = get_db_connection()
-    settings = conn.execute('SELECT * FROM order_settings').fetchall()
-    conn.close()
-    return {row['setting']: bool(row['value']) for row in settings}
+def get_order_settings(conn=None):
+    """ which users may order
+    :return: dict of user id to bool
+    """
+    conn = conn or get_connection()
+    return {row['id']: bool(row['can_order']) for row in conn.execute('SELECT id, can_order FROM users')}
 
-def get_user_current_order(user_id):
-    user = get_user_by_id(user_id)
-    if not user:
-        return None
-    conn = get_db_connection()
-    order = conn.execute('SELECT * FROM orders WHERE name = ? AND status != "delivered" ORDER BY timestamp DESC', (user['name'],)).fetchone()
-    conn.close()
+def set_can_order(enabled, user_id=None, gender=None, conn=None):
+    """ allow or stop ordering for one user, one gender category or, with
+    neither given, everyone; call inside a write transaction
+    :return: ids of the users updated
+    """
+    conn = conn or get_connection()
+    sql, params = "UPDATE users SET can_order = ?", [1 if enabled else 0]
+    if user_id is not None:
+        sql, params = sql + " WHERE id = ?", params + [user_id]
+    elif gender is not None:
+        sql, params = sql + " WHERE gender = ?", params + [gender]
+    return [row['id'] for row in conn.execute(sql + " RETURNING id", params)]
+
+def record_delivery(user_id, conn=None):
+    """ re-enable ordering for the owner of a delivered order and count the
+    delivery; call inside a write transaction
+    :param user_id: id of the order's owner
+    :return:
+    """
+    conn = conn or get_connection()
+    conn.execute("UPDATE users SET can_order = 1, delivered_count = delivered_count + 1 WHERE id = ?", (user_id,))
+
+def get_user_current_order(user_id, conn=None):
+    conn = conn or get_connection()
+    order = conn.execute('SELECT * FROM orders WHERE user_id = ? AND status != "delivered" ORDER BY timestamp DESC LIMIT 1', (user_id,)).fetchone()
     return dict(order) if order else None
 
-def can_user_order(user_id):
-    user = get_user_by_id(user_id)
-    if not user:
-        return False
-    settings = get_order_settings()
-    return settings.get(f"user_{user_id}", False)
+def can_user_order(user_id, conn=None):
+    conn = conn or get_connection()
+    row = conn.execute('SELECT can_order FROM users WHERE id = ?', (user_id,)).fetchone()
+    return bool(row and row['can_order'])
+
+def get_delivered_count(user_id, conn=None):
+    """ number of the user's orders delivered so far
+    :param user_id: id of the user
+    :return: int, 0 for an unknown user
+    """
+    conn = conn or get_connection()
+    row = conn.execute('SELECT delivered_count FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row['delivered_count'] if row else 0
 
-def is_user_delivery(user_id):
-    user = get_user_by_id(user_id)
+def is_user_delivery(user_id, conn=None):
+    user = get_user_by_id(user_id, conn)
     return user and user.get('is_delivery')
 
-def get_option_keys():
-    ingredients = get_ingredients()
-    return [ing["name"].lower().replace(" ", "_") for ing in ingredients]
+def get_option_keys(conn=None):
+    ingredients = get_ingredients(conn)
+    return [_option_key(ing["name"]) for ing in ingredients]
 
-def get_progress(order_id):
-    conn = get_db_connection()
-    progress = conn.execute('SELECT * FROM order_progress WHERE order_id = ?', (order_id,)).fetchall()
-    conn.close()
-    return [dict(row) for row in progress]
+def get_progress(order_id, conn=None):
+    return [{'order_id': order_id, 'ingredient': key, 'checked': 1}
+            for key in get_progress_by_order([order_id], conn)[order_id]]
 
-def get_ready_orders_for_delivery():
-    conn = get_db_connection()
+def set_progress(order_id, ticks, conn=None):
+    """ tick or untick ingredients of an order; call inside a write transaction
+    :param order_id: id of the order
+    :param ticks: list of (ingredient id, checked) pairs
+    :return:
+    """
+    conn = conn or get_connection()
+    conn.executemany('INSERT INTO order_progress (order_id, ingredient_id, checked) VALUES (?, ?, 1) '
+                     'ON CONFLICT DO NOTHING', [(order_id, i) for i, checked in ticks if checked])
+    conn.executemany('DELETE FROM order_progress WHERE order_id = ? AND ingredient_id = ?',
+                     [(order_id, i) for i, checked in ticks if not checked])
+
+def get_progress_by_order(order_ids, conn=None):
+    """ the checked ingredients of several orders in one query
+    :param order_ids: list of order ids
+    :return: dict of order id to list of ingredient keys, for every order id
+    """
+    conn = conn or get_connection()
+    option_keys = _cached('ingredients', _load_ingredients, conn)['option_keys']
+    progress = {order_id: [] for order_id in order_ids}
+    placeholders = ','.join('?' * len(progress))
+    for row in conn.execute(f'SELECT order_id, ingredient_id FROM order_progress WHERE order_id IN ({placeholders})', list(progress)):
+        # Ticks of since-deleted ingredients are left out
+        if row['ingredient_id'] in option_keys:
+            progress[row['order_id']].append(option_keys[row['ingredient_id']])
+    return progress
+
+def get_ready_orders_for_delivery(conn=None):
+    conn = conn or get_connection()
     orders = conn.execute('SELECT * FROM orders WHERE status = "ready"').fetchall()
-    conn.close()
     return [dict(row) for row in orders]
 
-def get_my_deliveries(user_id):
-    user = get_user_by_id(user_id)
-    if not user:
-        return []
-    conn = get_db_connection()
-    orders = conn.execute('SELECT * FROM orders WHERE status = "out_for_delivery" AND collected_by = ?', (user['name'],)).fetchall()
-    conn.close()
+def get_my_deliveries(user_id, conn=None):
+    conn = conn or get_connection()
+    orders = conn.execute('SELECT * FROM orders WHERE courier_id = ? AND status = "out_for_delivery"', (user_id,)).fetchall()
     return [dict(row) for row in orders]
 
-def get_delivered_orders():
-    conn = get_db_connection()
-    orders = conn.execute('SELECT * FROM orders WHERE status = "delivered" ORDER BY delivered_at DESC LIMIT 20').fetchall()
-    conn.close()
-    return [dict(row) for row in orders]
+def get_delivered_orders(conn=None, limit=20):
+    conn = conn or get_connection()
+    return _load_orders(conn, 'WHERE status = "delivered" ORDER BY delivered_at DESC LIMIT ?', (limit,))
+
+def get_user_order_history(user_id, conn=None):
+    """ a user's delivered orders, archived ones included, oldest first """
+    conn = conn or get_connection()
+    where, params = 'WHERE user_id = ? AND status = "delivered"', (user_id,)
+    return _load_orders(conn, where, params, archived=True) + _load_orders(conn, where, params)
+
+# Finished orders that archive_orders() moves out of orders; delivered ones
+# age from delivered_at, cancelled ones from when they were placed
+_ARCHIVABLE = "(status = 'delivered' AND delivered_at < ?) OR (status = 'cancelled' AND timestamp < ?)"
+
+def archive_orders(before, batch_size=500, conn=None):
+    """ move one batch of delivered and cancelled orders finished before a
+    time into archived_orders, in one transaction
+    :param before: ISO timestamp
+    :param batch_size: maximum number of orders moved
+    :param conn: Connection object
+    :return: number of orders archived
+    """
+    conn = conn or get_connection()
+    batch = f"SELECT id FROM orders WHERE {_ARCHIVABLE} ORDER BY id LIMIT ?"
+    params = (before, before, batch_size)
+    with write_transaction(conn):
+        conn.execute(f"""INSERT INTO archived_orders (id, user_id, name, person_type, order_count, additional_instructions, status,
+                                                      timestamp, courier_id, collected_by, collected_at, delivered_at, archived_at)
+                         SELECT id, user_id, name, person_type, order_count, additional_instructions, status,
+                                timestamp, courier_id, collected_by, collected_at, delivered_at, ?
+                         FROM orders WHERE id IN ({batch})""", (datetime.now().isoformat(), *params))
+        conn.execute(f"""INSERT OR IGNORE INTO archived_order_ingredients (order_id, ingredient_id)
+                         SELECT order_id, ingredient_id FROM order_ingredients WHERE order_id IN ({batch})""", params)
+        conn.execute(f"DELETE FROM order_progress WHERE order_id IN ({batch})", params)
+        conn.execute(f"DELETE FROM order_ingredients WHERE order_id IN ({batch})", params)
+        return conn.execute(f"DELETE FROM orders WHERE id IN ({batch})", params).rowcount
+
+def clear_archive(conn=None):
+    """ delete every archived order and reset the delivered counters; call
+    inside a write transaction
+    """
+    conn = conn or get_connection()
+    conn.execute("DELETE FROM archived_order_ingredients")
+    conn.execute("DELETE FROM archived_orders")
+    conn.execute("UPDATE users SET delivered_count = 0")
+
+def hash_token(token):
+    return hashlib.sha256(token.encode()).digest()
+
+def get_magic_links(user_ids, conn=None):
+    """ the newest stored magic link of each user
+    :param user_ids: list of user ids
+    :return: dict of user id to magic_links row
+    """
+    conn = conn or get_connection()
+    placeholders = ','.join('?' * len(user_ids))
+    rows = conn.execute(f"SELECT * FROM magic_links WHERE user_id IN ({placeholders}) ORDER BY expires_at", list(user_ids))
+    return {row['user_id']: row for row in rows}
+
+def replace_magic_links(links, conn=None):
+    """ store new magic links, deleting any older ones of the same users;
+    call inside a write transaction
+    :param links: list of (user_id, token, expires_at) tuples
+    :return:
+    """
+    conn = conn or get_connection()
+    conn.executemany("DELETE FROM magic_links WHERE user_id = ?", [(user_id,) for user_id, _, _ in links])
+    conn.executemany("INSERT INTO magic_links (user_id, token, token_hash, expires_at) VALUES (?, ?, ?, ?)",
+                     [(user_id, token, hash_token(token), expires_at) for user_id, token, expires_at in links])
+
+def consume_magic_link(token, conn=None):
+    """ delete a magic link and return it, so each link logs in once
+    :param token: the token from the link
+    :return: the deleted row, or None if there was no unexpired link
+    """
+    conn = conn or get_connection()
+    with write_transaction(conn):
+        row = conn.execute("DELETE FROM magic_links WHERE token_hash = ? RETURNING user_id, expires_at",
+                           (hash_token(token),)).fetchone()
+    if row is None or row['expires_at'] <= datetime.now().isoformat():
+        return None
+    return row
 
-def get_user_order_history(user_id):
-    user = get_user_by_id(user_id)
-    if not user:
-        return []
-    conn = get_db_connection()
-    orders = conn.execute('SELECT * FROM orders WHERE name = ? AND status = "delivered"', (user['name'],)).fetchall()
-    
-    orders_list = []
-    for o in orders:
-        order_dict = dict(o)
-        ingredients = get_order_ingredients(o['id'])
-        for ingredient in ingredients:
-            order_dict[ingredient['name'].lower().replace(' ', '_')] = "True"
-        orders_list.append(order_dict)
-    conn.close()
-    return orders_list
+def delete_expired_magic_links(conn=None):
+    """ remove magic links past their expiry
+    :return: number of rows deleted
+    """
+    conn = conn or get_connection()
+    with write_transaction(conn):
+        return conn.execute("DELETE FROM magic_links WHERE expires_at <= ?", (datetime.now().isoformat(),)).rowcount
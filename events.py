@@ -0,0 +1,91 @@
+"""Durable log of the events sent to Socket.IO clients.
+
+Every event is appended to order_events in the same transaction as the
+change it describes, so sequence numbers are shared by all workers and
+survive restarts, and a reconnecting client can replay what it missed from
+any of them. compact() keeps the log bounded. Event streams in this process
+wait() for committed events instead of polling the table.
+"""
+import json
+import threading
+from datetime import datetime
+
+import database as db
+
+# Events replayed at most; a client further behind reloads instead
+MAX_REPLAY = 1000
+
+_committed = threading.Condition()
+
+def publish(event, payload=None, rooms=None, conn=None):
+    """ record an event under the next sequence number; call inside the write
+    transaction of the change it describes
+    :param event: event name, e.g. 'order_updated'
+    :param payload: dict of event data
+    :param rooms: Socket.IO rooms the event is addressed to, None for everyone
+    :param conn: Connection object
+    :return: the event dict as sent to clients, including 'seq' and 'event'
+    """
+    conn = conn or db.get_connection()
+    payload = payload or {}
+    with db.write_transaction(conn):
+        seq = conn.execute("INSERT INTO order_events (event, order_id, rooms, payload, created_at) VALUES (?, ?, ?, ?, ?) RETURNING seq",
+                           (event, payload.get('order_id'), None if rooms is None else json.dumps(rooms),
+                            json.dumps(payload), datetime.now().isoformat())).fetchone()[0]
+    return dict(payload, seq=seq, event=event)
+
+def last_seq(conn=None):
+    conn = conn or db.get_connection()
+    # The AUTOINCREMENT high-water mark, which compaction leaves in place
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'order_events'").fetchone()
+    return row[0] if row else 0
+
+def since(seq, rooms=None, conn=None):
+    """ return the events after seq addressed to any of rooms, oldest first
+    :param seq: last sequence number the client has seen
+    :param rooms: the client's rooms, None to return every event
+    :param conn: Connection object
+    :return: list of events, or None if some of them are no longer retained
+    """
+    conn = conn or db.get_connection()
+    last = last_seq(conn)
+    if seq > last:
+        # Not from this database; the client must reload
+        return None
+    rows = conn.execute("SELECT seq, event, rooms, payload FROM order_events WHERE seq > ? ORDER BY seq LIMIT ?",
+                        (seq, MAX_REPLAY + 1)).fetchall()
+    if seq < last and (not rows or rows[0]['seq'] > seq + 1):
+        # Compacted away
+        return None
+    if len(rows) > MAX_REPLAY:
+        return None
+    events = []
+    for row in rows:
+        event_rooms = None if row['rooms'] is None else json.loads(row['rooms'])
+        if rooms is None or event_rooms is None or set(rooms) & set(event_rooms):
+            events.append(dict(json.loads(row['payload']), seq=row['seq'], event=row['event']))
+    return events
+
+def compact(before, conn=None):
+    """ delete events recorded before a time
+    :param before: ISO timestamp
+    :param conn: Connection object
+    :return: number of events deleted
+    """
+    conn = conn or db.get_connection()
+    with db.write_transaction(conn):
+        return conn.execute("DELETE FROM order_events WHERE created_at < ?", (before,)).rowcount
+
+def committed():
+    """ wake the streams waiting in wait(); call once a published event commits """
+    with _committed:
+        _committed.notify_all()
+
+def wait(timeout):
+    """ block until an event commits in this process or timeout seconds pass;
+    events from other workers are only seen once it times out
+    :param timeout: seconds
+    :return: True if woken by an event
+    """
+    with _committed:
+        return _committed.wait(timeout)
@@ -0,0 +1,160 @@
+"""Opt-in request profiling and Prometheus metrics.
+
+With METRICS=1 in config.properties every database connection is timed, each
+response carries a Server-Timing header with its SQL query count, SQL time,
+lock waits and connection opens, and /metrics serves this process's counters
+in the Prometheus text format. Each serve.py worker reports its own.
+"""
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, g, has_app_context, request
+
+# Request latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_requests = defaultdict(lambda: [0] * (len(BUCKETS) + 1) + [0.0])  # (method, route) -> bucket counts, +Inf, sum
+_responses = defaultdict(int)  # (method, route, status) -> count
+_emits = defaultdict(int)      # event name -> count
+_clients = {}                  # sid -> client kind
+_sql = {'queries': 0, 'seconds': 0.0, 'lock_waits': 0, 'lock_seconds': 0.0, 'connections': 0}
+
+def _verb(sql):
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+
+def _record(kind, seconds):
+    stats = g.setdefault('sql_stats', defaultdict(float)) if has_app_context() else None
+    with _lock:
+        if kind == 'connect':
+            _sql['connections'] += 1
+        elif kind == 'lock':
+            _sql['lock_waits'] += 1
+            _sql['lock_seconds'] += seconds
+        else:
+            _sql['queries'] += 1
+            _sql['seconds'] += seconds
+    if stats is not None:
+        stats[kind + '_count'] += 1
+        stats[kind + '_seconds'] += seconds
+
+class TimingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            # An explicit BEGIN IMMEDIATE (see write_transaction) waits for the write lock
+            _record('lock' if _verb(sql) == 'BEGIN' else 'query', time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record('query', time.perf_counter() - started)
+
+class TimingConnection(sqlite3.Connection):
+    """Connection that records query, lock wait and open times."""
+
+    def __init__(self, *args, **kwargs):
+        started = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        _record('connect', time.perf_counter() - started)
+
+    def cursor(self, factory=TimingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def count_emit(event):
+    with _lock:
+        _emits[event] += 1
+
+def client_connected(sid, kind):
+    with _lock:
+        _clients[sid] = kind
+
+def client_disconnected(sid):
+    with _lock:
+        _clients.pop(sid, None)
+
+def _start_timer():
+    g.request_started = time.perf_counter()
+
+def _finish_timer(response):
+    elapsed = time.perf_counter() - g.pop('request_started', time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    with _lock:
+        counts = _requests[(request.method, route)]
+        for i, bound in enumerate(BUCKETS):
+            if elapsed <= bound:
+                counts[i] += 1
+        counts[len(BUCKETS)] += 1
+        counts[-1] += elapsed
+        _responses[(request.method, route, response.status_code)] += 1
+
+    stats = g.get('sql_stats', {})
+    response.headers['Server-Timing'] = ', '.join([
+        f'sql;desc="{int(stats.get("query_count", 0))} queries";dur={stats.get("query_seconds", 0) * 1000:.2f}',
+        f'lock;desc="{int(stats.get("lock_count", 0))} waits";dur={stats.get("lock_seconds", 0) * 1000:.2f}',
+        f'connect;desc="{int(stats.get("connect_count", 0))} opened";dur={stats.get("connect_seconds", 0) * 1000:.2f}',
+        f'total;dur={elapsed * 1000:.2f}',
+    ])
+    return response
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+def render():
+    """ this process's metrics in the Prometheus text exposition format """
+    lines = []
+    with _lock:
+        lines += ['# HELP kitchen_request_duration_seconds Request latency by route.',
+                  '# TYPE kitchen_request_duration_seconds histogram']
+        for (method, route), counts in sorted(_requests.items()):
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                lines.append(f'kitchen_request_duration_seconds_bucket{_labels(method=method, route=route, le=bound)} {count}')
+            lines.append(f'kitchen_request_duration_seconds_sum{_labels(method=method, route=route)} {counts[-1]:.6f}')
+            lines.append(f'kitchen_request_duration_seconds_count{_labels(method=method, route=route)} {counts[len(BUCKETS)]}')
+
+        lines += ['# HELP kitchen_responses_total Responses by route and status code.',
+                  '# TYPE kitchen_responses_total counter']
+        for (method, route, status), count in sorted(_responses.items()):
+            lines.append(f'kitchen_responses_total{_labels(method=method, route=route, status=status)} {count}')
+
+        lines += ['# HELP kitchen_socketio_emits_total Socket.IO events emitted by notify_clients.',
+                  '# TYPE kitchen_socketio_emits_total counter']
+        for event, count in sorted(_emits.items()):
+            lines.append(f'kitchen_socketio_emits_total{_labels(event=event)} {count}')
+
+        lines += ['# HELP kitchen_socketio_connected_clients Connected Socket.IO clients.',
+                  '# TYPE kitchen_socketio_connected_clients gauge']
+        for kind in ('kitchen', 'delivery', 'customer', 'anonymous'):
+            count = sum(1 for k in _clients.values() if k == kind)
+            lines.append(f'kitchen_socketio_connected_clients{_labels(kind=kind)} {count}')
+
+        for name, key, kind, help_text in (
+            ('kitchen_sqlite_queries_total', 'queries', 'counter', 'SQL statements executed.'),
+            ('kitchen_sqlite_query_seconds_total', 'seconds', 'counter', 'Time spent executing SQL statements.'),
+            ('kitchen_sqlite_lock_waits_total', 'lock_waits', 'counter', 'BEGIN statements, which wait for the write lock.'),
+            ('kitchen_sqlite_lock_wait_seconds_total', 'lock_seconds', 'counter', 'Time spent waiting in BEGIN.'),
+            ('kitchen_sqlite_connections_opened_total', 'connections', 'counter', 'Database connections opened.'),
+        ):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}', f'{name} {_sql[key]}']
+    return '\n'.join(lines) + '\n'
+
+def init_app(app, config):
+    """ turn on profiling and /metrics when config has METRICS=1 """
+    if config.get('METRICS') != '1':
+        return
+    app.config['DB_CONNECTION_FACTORY'] = TimingConnection
+    app.before_request(_start_timer)
+    app.after_request(_finish_timer)
+    app.add_url_rule('/metrics', 'metrics', lambda: Response(render(), mimetype='text/plain; version=0.0.4'))
@@ -0,0 +1,101 @@
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+# Rendering settings, overridable from config.properties with QR_<NAME> keys
+SETTINGS = {
+    'workers': 2,       # render processes; 0 renders in the calling thread
+    'cache_size': 500,  # PNGs kept, least recently used dropped first
+}
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # token -> (expires, png bytes)
+_pool = None
+
+def configure(config):
+    """ apply QR_* overrides from the loaded config.properties
+    :param config: dict of config keys to values
+    :return:
+    """
+    for name in SETTINGS:
+        value = config.get(f"QR_{name.upper()}")
+        if value:
+            SETTINGS[name] = int(value)
+
+def render_png(data):
+    """ encode data as a QR code PNG; runs in the render processes
+    :param data: text to encode, e.g. a magic link
+    :return: PNG bytes
+    """
+    # Imported on first use so workers start without it
+    import qrcode
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    img = qr.make_image(fill_color="black", back_color="white")
+    buf = BytesIO()
+    img.save(buf)
+    return buf.getvalue()
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None:
+            # spawn: forking a threaded server process is not safe
+            _pool = ProcessPoolExecutor(SETTINGS['workers'], mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+def _lookup(token):
+    with _lock:
+        entry = _cache.get(token)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del _cache[token]
+            return None
+        _cache.move_to_end(token)
+        return entry[1]
+
+def _store(token, expires, png):
+    with _lock:
+        _cache[token] = (expires, png)
+        _cache.move_to_end(token)
+        while len(_cache) > SETTINGS['cache_size']:
+            _cache.popitem(last=False)
+
+def get_pngs(links):
+    """ QR code PNGs for magic links, rendered once per token
+    :param links: list of (token, link, expires) tuples; expires is a UNIX
+        timestamp, after which the cached image is dropped
+    :return: list of PNG bytes in the same order
+    """
+    pngs = [_lookup(token) for token, _, _ in links]
+    missing = [i for i, png in enumerate(pngs) if png is None]
+    if missing:
+        data = [links[i][1] for i in missing]
+        if SETTINGS['workers'] > 0:
+            rendered = list(_get_pool().map(render_png, data))
+        else:
+            rendered = [render_png(d) for d in data]
+        for i, png in zip(missing, rendered):
+            token, _, expires = links[i]
+            _store(token, expires, png)
+            pngs[i] = png
+    return pngs
+
+def get_png(token, link, expires):
+    return get_pngs([(token, link, expires)])[0]
+
+def discard(token):
+    """ drop a token's image, e.g. once the link has been used """
+    with _lock:
+        _cache.pop(token, None)
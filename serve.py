@@ -0,0 +1,93 @@
+"""Production entry point.
+
+Runs `kitchen init-db` (schema, seed data and the admin link), the expired
+magic link sweeper and the order archiver and event log compactor once, then
+starts WORKERS server processes on consecutive ports from PORT (5001, 5002,
+...) using ASYNC_MODE (gevent when it is installed, threading otherwise).
+With more than one worker Socket.IO emits are shared through MESSAGE_QUEUE,
+which defaults to a SQLite file next to the database; put the workers behind
+a proxy with sticky sessions (e.g. nginx ip_hash) so polling clients stay on
+one process:
+
+    KITCHEN_WORKERS=4 python serve.py
+
+gevent is in requirements.txt. In threading mode the workers run the
+Werkzeug development server, so serve.py refuses to start more than one of
+them. Under gevent every request in a worker shares one OS thread: a blocking
+sqlite3 call, such as a BEGIN IMMEDIATE waiting up to DB_BUSY_TIMEOUT for
+the write lock, stalls the whole worker until it returns. Add workers rather
+than raising the busy timeout.
+
+`python app.py` remains the single-process development server.
+"""
+import importlib.util
+import os
+import signal
+import subprocess
+import sys
+
+from settings import load_config
+
+def default_async_mode():
+    for mode in ('gevent', 'eventlet'):
+        if importlib.util.find_spec(mode):
+            return mode
+    return 'threading'
+
+def run_worker():
+    config = load_config()
+    async_mode = config.get('ASYNC_MODE', 'threading')
+    # Patch the standard library before anything imports it
+    if async_mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    elif async_mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    import app as kitchen
+    kitchen.socketio.run(kitchen.create_app(config), host=config.get('HOST', '0.0.0.0'), port=int(config.get('PORT', 5001)),
+                         debug=False, use_reloader=False, log_output=True, allow_unsafe_werkzeug=async_mode == 'threading')
+
+def main():
+    config = load_config()
+    workers = int(config.get('WORKERS', 1))
+    port = int(config.get('PORT', 5001))
+    worker_env = dict(os.environ, KITCHEN_ASYNC_MODE=config.get('ASYNC_MODE') or default_async_mode())
+    if workers > 1 and worker_env['KITCHEN_ASYNC_MODE'] == 'threading':
+        print("WORKERS > 1 needs ASYNC_MODE=gevent or eventlet (pip install -r requirements.txt); "
+              "threading only runs the development server", file=sys.stderr)
+        return 1
+    if workers > 1 and not config.get('MESSAGE_QUEUE'):
+        db_path = os.path.abspath(config.get('DB_PATH', 'kitchen.db'))
+        worker_env['KITCHEN_MESSAGE_QUEUE'] = f"sqlite://{db_path}-socketio"
+
+    # Setup runs once here; this process never serves, so it stays on threading
+    # and only publishes the archiver's broadcasts to the workers
+    import app as kitchen
+    queue = worker_env.get('KITCHEN_MESSAGE_QUEUE', config.get('MESSAGE_QUEUE', ''))
+    app = kitchen.create_app(dict(config, ASYNC_MODE='threading', MESSAGE_QUEUE=queue, MESSAGE_QUEUE_WRITE_ONLY='1'),
+                             check_schema=False)
+    with app.app_context():
+        kitchen.init_db()
+    # One sweeper and archiver for all workers
+    kitchen.socketio.start_background_task(kitchen.sweep_magic_links, app)
+    kitchen.socketio.start_background_task(kitchen.sweep_orders, app)
+
+    processes = []
+    for i in range(workers):
+        env = dict(worker_env, KITCHEN_PORT=str(port + i))
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker'], env=env))
+        print(f"Worker {i + 1}/{workers} ({worker_env['KITCHEN_ASYNC_MODE']}) on port {port + i}")
+
+    def stop(signum, frame):
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    return max(process.wait() for process in processes)
+
+if __name__ == "__main__":
+    if '--worker' in sys.argv:
+        run_worker()
+    else:
+        sys.exit(main())
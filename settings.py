@@ -0,0 +1,18 @@
+import os
+
+# Load BASE_URL from config.properties
+def load_config():
+    config = {}
+    config_file = os.path.join(os.path.dirname(__file__), 'config.properties')
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    key, value = line.split('=', 1)
+                    config[key.strip()] = value.strip()
+    # KITCHEN_<KEY> environment variables override the file, e.g. KITCHEN_DB_PATH
+    for key, value in os.environ.items():
+        if key.startswith('KITCHEN_'):
+            config[key[len('KITCHEN_'):]] = value
+    return config
@@ -0,0 +1,63 @@
+import json
+import sqlite3
+import threading
+import time
+
+import socketio
+
+class SQLiteQueueManager(socketio.PubSubManager):
+    """Socket.IO client manager that shares emits between worker processes
+    through a table in a SQLite file.
+
+    A local stand-in for the Redis/Kafka message queues when every worker
+    runs on the same machine: each emit is inserted as a row and every
+    worker polls for rows it has not seen yet.
+    """
+    name = 'sqlite'
+
+    def __init__(self, url='sqlite://socketio-queue.db', channel='flask-socketio', write_only=False,
+                 logger=None, poll_interval=0.05, retention=60):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = url[len('sqlite://'):]
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS socketio_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                channel TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+            conn.commit()
+            self._local.conn = conn
+        return conn
+
+    def _publish(self, data):
+        conn = self._connect()
+        conn.execute("INSERT INTO socketio_messages (channel, payload, created_at) VALUES (?, ?, ?)",
+                     (self.channel, json.dumps(data), time.time()))
+        conn.commit()
+
+    def _listen(self):
+        conn = self._connect()
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM socketio_messages").fetchone()[0]
+        last_prune = time.time()
+        while True:
+            rows = conn.execute("SELECT id, payload FROM socketio_messages WHERE id > ? AND channel = ? ORDER BY id",
+                                (last_id, self.channel)).fetchall()
+            conn.commit()
+            for last_id, payload in rows:
+                yield payload
+            if time.time() - last_prune > self.retention:
+                # Every worker has long since read these
+                last_prune = time.time()
+                conn.execute("DELETE FROM socketio_messages WHERE created_at < ?", (last_prune - self.retention,))
+                conn.commit()
+            self.server.sleep(self.poll_interval)
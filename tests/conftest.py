@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app as kitchen
+
+
+@pytest.fixture
+def app(tmp_path):
+    """An app on a fresh database in tmp_path, with the admin user as id 1."""
+    app = kitchen.create_app({'DB_PATH': str(tmp_path / 'kitchen.db'), 'BASE_URL': 'http://localhost'},
+                             check_schema=False)
+    with app.app_context():
+        kitchen.init_db()
+    return app
+
+
+@pytest.fixture
+def admin_client(app):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    return client
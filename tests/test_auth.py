@@ -0,0 +1,45 @@
+"""Session and role checks."""
+import sqlite3
+
+import database as db
+
+
+def test_deleted_user_is_refused_on_every_worker(app, admin_client):
+    """Deleting a user must end their sessions on every worker at once."""
+    admin_client.post('/api/users', json={'username': 'cook', 'name': 'Cook'})
+    with app.app_context():
+        user = db.get_user_by_username('cook')
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user['id']
+        session['user_version'] = user['session_version']
+    assert client.get('/api/orders/changes').status_code == 200
+
+    # What delete_user does on another worker: this process's users cache is untouched
+    with sqlite3.connect(app.config['DB_PATH']) as conn:
+        conn.execute("DELETE FROM users WHERE id = ?", (user['id'],))
+        conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'users'")
+
+    assert client.get('/api/orders/changes').status_code == 401
+
+
+def test_progress_batch_requires_admin(app, admin_client):
+    admin_client.post('/api/users', json={'username': 'customer', 'name': 'Customer'})
+    with app.app_context():
+        user = db.get_user_by_username('customer')
+    ticks = {'ticks': [{'order_id': 1, 'ingredient': 'tomatoes', 'checked': True}]}
+    assert app.test_client().post('/api/orders/progress', json=ticks).status_code == 401
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user['id']
+    assert client.post('/api/orders/progress', json=ticks).status_code == 403
+    assert admin_client.post('/api/orders/progress', json=ticks).status_code == 404
+
+
+def test_repeated_user_ids_get_one_magic_link(app, admin_client):
+    admin_client.post('/api/users', json={'username': 'rider', 'name': 'Rider'})
+    with app.app_context():
+        user_id = db.get_user_by_username('rider')['id']
+    response = admin_client.post('/api/users/magic-links', json={'user_ids': [user_id, user_id, str(user_id)]})
+    assert response.status_code == 200
+    assert [link['user_id'] for link in response.get_json()] == [user_id]
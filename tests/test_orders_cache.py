@@ -0,0 +1,28 @@
+"""Cached reads must be invalidated by the changes they depend on, and only by those."""
+import database as db
+
+
+def test_ingredient_rename_invalidates_order_listing(app, admin_client):
+    first = admin_client.get('/api/orders')
+    assert admin_client.get('/api/orders', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+    ingredient = admin_client.get('/api/ingredients').get_json()[0]
+    admin_client.put(f"/api/ingredients/{ingredient['id']}", json=dict(ingredient, name='Renamed'))
+
+    second = admin_client.get('/api/orders', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert second.last_modified is not None
+
+
+def test_delivery_leaves_users_cache_valid(app):
+    with app.app_context():
+        conn = db.get_connection()
+        db.get_users(conn)
+        version = db._cache_version('users', conn)
+        with db.write_transaction(conn):
+            db.set_can_order(False, user_id=1, conn=conn)
+            db.record_delivery(1, conn)
+        assert db._cache_version('users', conn) == version
+        assert db.can_user_order(1, conn)
+        assert db.get_delivered_count(1, conn) == 1
@@ -0,0 +1,45 @@
+"""GET /api/orders must issue the same number of queries for any number of orders."""
+import sqlite3
+from datetime import datetime
+
+import database as db
+
+statements = []
+
+
+class CountingConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(statements.append)
+
+
+def add_orders(app, count):
+    with app.app_context():
+        conn = db.get_connection()
+        option_ids = list(db.get_option_map().values())
+        with db.write_transaction(conn):
+            for _ in range(count):
+                order_id = conn.execute(
+                    "INSERT INTO orders (user_id, name, person_type, order_count, additional_instructions, status, timestamp) "
+                    "VALUES (1, 'Administrator', 'Male', 1, '', 'preparing', ?)", (datetime.now().isoformat(),)).lastrowid
+                conn.executemany("INSERT INTO order_ingredients (order_id, ingredient_id) VALUES (?, ?)",
+                                 [(order_id, ingredient_id) for ingredient_id in option_ids[:3]])
+                db.set_progress(order_id, [(option_ids[0], True)], conn)
+
+
+def count_queries(client):
+    client.get('/api/orders')  # Warm the per-process caches
+    statements.clear()
+    response = client.get('/api/orders')
+    assert response.status_code == 200
+    return len(response.get_json()), len(statements)
+
+
+def test_order_list_queries_do_not_grow_with_orders(app, admin_client):
+    app.config['DB_CONNECTION_FACTORY'] = CountingConnection
+    counts = []
+    for batch in (1, 9, 40):
+        add_orders(app, batch)
+        counts.append(count_queries(admin_client))
+    assert [orders for orders, _ in counts] == [1, 10, 50]
+    assert len({queries for _, queries in counts}) == 1, counts